@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 # -*- python-indent-offset: 4 -*-
 
+import os
 import sys
 import json
 from pathlib import Path
 
 update_dir = Path("/var/www/hip.zijistark.com/hiphub")
+# hiphub reads push events from here while it's running. it's outside the web root, and only hiphub's group (which
+# the web server's user must be in) may write to it.
+fifo_path = Path("/run/hiphub/events.fifo")
 
 tracked_repos = [
     'Aasmul/SWMH-BETA',
@@ -21,6 +25,21 @@ tracked_repos = [
 ]
 
 
+# Tell hiphub about the push right away. The FIFO can only be opened while hiphub has it open for reading, and
+# if hiphub isn't running (or is too far behind), it'll still notice the head file's new mtime when polling.
+def notify_hiphub(event):
+    try:
+        fd = os.open(str(fifo_path), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    try:
+        os.write(fd, event.encode())  # a single write of at most PIPE_BUF bytes, so it's never interleaved
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def main():
     print("Content-Type: text/plain")
     print()
@@ -58,6 +77,8 @@ def main():
     with (update_dir / filename).open("w") as f:
         print(payload["after"], file=f)
 
+    notify_hiphub("{}:{} {} {}\n".format(name, branch, payload["before"], payload["after"]))
+
     print("Thanks for the update!")
     return 0
 
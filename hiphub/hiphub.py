@@ -9,13 +9,18 @@ import sys
 import pwd
 import time
 import random
+import select
 import signal
 import daemon
+import sqlite3
 import hashlib
 import logging
+import stat
 import lockfile
 import datetime
+import threading
 import subprocess
+import concurrent.futures
 from pathlib import Path
 import slack
 
@@ -24,13 +29,23 @@ import slack
 g_daemon_user = 'hiphub'  # user hiphub should run as (will use user's default group)
 g_base_dir = Path('/home') / g_daemon_user  # daemon state will be kept under here
 g_root_repo_dir = g_base_dir / 'git'  # root folder of all the hiphub git repositories
+g_worktree_dir = g_base_dir / 'worktrees'  # root folder of the git worktrees of tracked heads other than the clones' own
 g_webroot_dir = Path('/var/www/hip.zijistark.com')
 g_webhook_dir = g_webroot_dir / 'hiphub'  # folder where the webhook hints us as to new commit activity
+# the webhook also announces each push through a FIFO, with its before/after SHAs. it's kept out of the web root, in
+# a folder that only we and our group (of which the web server's user must be a member) can enter.
+g_webhook_fifo_dir = Path('/run/hiphub')
+g_webhook_fifo_path = g_webhook_fifo_dir / 'events.fifo'
+g_webhook_poll_interval = 60  # seconds between polls of the webhook folder for pushes that didn't come through the FIFO
 g_emfbeta_name = 'emf_beta.zip'
 g_emfbeta_path = g_webroot_dir / 'pub' / g_emfbeta_name
 g_gitbin_path = Path('/usr/bin/git')
 g_rsyncbin_path = Path('/usr/bin/rsync')
 g_zipbin_path = Path('/usr/bin/zip')
+# checksum algorithm of the EMF beta manifest. the installer can only check the beta's files if this matches the
+# current HIP release's manifest (shrinkwrap.py --hash), so switch it along with the releases.
+g_emfbeta_hash = 'md5'
+g_manifest_version = 2
 
 # repos and respective branches which we track
 g_repos = {
@@ -58,8 +73,18 @@ g_webrepos = {
     'LTM': 'https://github.com/Leybrook',
 }
 
+# repos whose checkouts the processing of each repo's heads reads from (via rebuild_* functions), so that they may
+# be processed first. see order_jobs().
+g_repo_deps = {
+    'MiniSWMH': ['SWMH-BETA', 'ck2utils'],
+    'EMF': ['SWMH-BETA', 'ck2utils'],
+    'sed2': ['SWMH-BETA', 'MiniSWMH', 'EMF'],
+}
+
 g_pidfile_path = g_base_dir / 'hiphub.pid'  # we mark our currently running PID here
 g_state_dir = g_base_dir / 'state'  # we store the last-processed SHA for each tracked head within files in this folder
+g_queue_path = g_base_dir / 'queue.db'  # SQLite database of the heads still to be processed, which survives restarts
+g_max_workers = 4  # most jobs (and most tasks within a job) to run at once
 g_logfile_path = g_base_dir / 'hiphub.log'  # we log info and errors here (once the daemon is off the ground and no longer attached to a session/terminal)
 
 ##########
@@ -104,12 +129,13 @@ def slack_errmsg(task, repo=None, branch=None, cmd=None, rc=None, stderr='', rev
         slack.isis_sendmsg('```\n{}\n```'.format(stderr))
 
     
-def git_run(args, retry=False):
+# NOTE: jobs and tasks run in threads, so nothing may os.chdir(); git (and everything else) is run with a cwd instead
+def git_run(args, retry=False, cwd=None):
     cmd = [str(g_gitbin_path)] + args
     n_tries = 0
 
     while True:
-        cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=cwd)
         n_tries += 1
 
         if cp.returncode == 0:
@@ -129,38 +155,90 @@ def git_run(args, retry=False):
             time.sleep(60)
 
 
-def update_head(repo, branch):
-    logging.debug('updating head: %s/%s', repo, branch)
-    os.chdir(str(g_root_repo_dir / repo))
+# every tracked head has a working tree of its own which always stays on its branch, so that nothing need switch
+# branches and heads of the same repo may be worked on at once: the repo's clone itself for its first tracked
+# branch (where the build scripts expect to find it), and a linked worktree for any other.
+def head_dir(repo, branch):
+    if branch == g_repos[repo][0]:
+        return g_root_repo_dir / repo
+    return g_worktree_dir / '{}:{}'.format(repo, branch)
 
-    # first, make the repo a carbon copy of HEAD -- remove changes to index, remove untracked changes
-    git_run(['reset', '--hard', 'HEAD'])
-    git_run(['clean', '-df'])
 
-    # now checkout the desired branch and pull
-    git_run(['fetch'], retry=True)
-    git_run(['checkout', branch])
-    git_run(['pull'], retry=True)
+# a branch can only be checked out in one worktree, and the clone's must be the repo's first tracked branch. this
+# runs no git commands unless there's something to fix.
+def init_worktrees():
+    for repo in g_repos:
+        clone_dir = str(g_root_repo_dir / repo)
+        with (g_root_repo_dir / repo / '.git' / 'HEAD').open() as f:
+            clone_branch = f.read().strip()
+        if clone_branch != 'ref: refs/heads/' + g_repos[repo][0]:
+            logging.info('switching clone of %s to its first tracked branch: %s', repo, g_repos[repo][0])
+            git_run(['reset', '--hard', 'HEAD'], cwd=clone_dir)
+            git_run(['clean', '-df'], cwd=clone_dir)
+            git_run(['checkout', g_repos[repo][0]], cwd=clone_dir)
+        for branch in g_repos[repo][1:]:
+            wt_dir = head_dir(repo, branch)
+            if not wt_dir.exists():
+                logging.info('creating worktree for %s/%s: %s', repo, branch, wt_dir)
+                git_run(['worktree', 'prune'], cwd=clone_dir)
+                git_run(['worktree', 'add', str(wt_dir), branch], cwd=clone_dir)
+
+
+g_repo_locks = {r: threading.Lock() for r in g_repos}  # held while fetching into a repo, as its worktrees share its refs
+g_remote_revs = {}  # (repo, branch) => SHA of the branch on GitHub as of our last fetch of the repo
+
+
+# fetches every tracked branch of the repo with one `git fetch`, and notes their SHAs
+def fetch_repo(repo):
+    logging.debug('fetching repo: %s', repo)
+    repo_dir = str(g_root_repo_dir / repo)
+    refspecs = ['+refs/heads/{0}:refs/remotes/origin/{0}'.format(b) for b in g_repos[repo]]
+    with g_repo_locks[repo]:
+        git_run(['fetch', 'origin'] + refspecs, retry=True, cwd=repo_dir)
+        cp = git_run(['for-each-ref', '--format=%(refname:lstrip=3) %(objectname)']
+                     + ['refs/remotes/origin/' + b for b in g_repos[repo]], cwd=repo_dir)
+    for line in cp.stdout.splitlines():
+        branch, rev = line.split()
+        g_remote_revs[(repo, branch)] = rev
+
+
+def fetch_repos(repos):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(repos)) as pool:
+        for f in [pool.submit(fetch_repo, r) for r in repos]:
+            f.result()
+
+
+# returns the head's SHA on GitHub. its repo isn't fetched if we already know the head to be at after (the SHA that
+# a push event said it was pushed to), and the head's worktree isn't touched (see sync_worktree).
+def update_head(repo, branch, after=None):
+    logging.debug('updating head: %s/%s', repo, branch)
+    if after is None or g_remote_revs.get((repo, branch)) != after:
+        fetch_repo(repo)
+    return g_remote_revs[(repo, branch)]
+
 
-    # determine the head's possibly-new SHA
-    cp = git_run(['rev-parse', 'HEAD'])
+# brings the head's worktree up to rev by merging it (as a pull would), which only rewrites the files that changed
+def sync_worktree(repo, branch, rev):
+    repo_dir = str(head_dir(repo, branch))
 
-    os.chdir(str(g_base_dir))
-    return cp.stdout.strip()
+    # a failed rebuild cleans up after itself, so the worktree should already be a carbon copy of HEAD. if it isn't
+    # (e.g., we died mid-rebuild), remove changes to index and untracked changes.
+    if has_this_repo_changed(repo_dir):
+        logging.warning('worktree of %s/%s has changes, so resetting it', repo, branch)
+        git_run(['reset', '--hard', 'HEAD'], cwd=repo_dir)
+        git_run(['clean', '-df'], cwd=repo_dir)
 
+    git_run(['merge', rev], cwd=repo_dir)
 
-def git_files_changed(repo, branch, old_rev, new_rev='HEAD'):
-    os.chdir(str(g_root_repo_dir / repo))
-    git_run(['checkout', branch])
-    cp = git_run(['log', '--pretty=format:', '-z', '--name-only', '{}..{}'.format(old_rev, new_rev)])
-    changed_files = { Path(path) for path in cp.stdout.split('\x00') if path }
 
-    os.chdir(str(g_base_dir))
-    return changed_files
+def git_files_changed(repo, branch, old_rev, new_rev):
+    repo_dir = str(g_root_repo_dir / repo)  # any of the repo's worktrees will do
+    cp = git_run(['log', '--pretty=format:', '-z', '--name-only', '{}..{}'.format(old_rev, new_rev)], cwd=repo_dir)
+    return { Path(path) for path in cp.stdout.split('\x00') if path }
 
 
-def has_this_repo_changed(ignored_file=None):
-    cp = git_run(['status', '-z'])  # filenames are terminated with NUL instead of line break
+def has_this_repo_changed(repo_dir, ignored_file=None):
+    cp = git_run(['status', '-z'], cwd=repo_dir)  # filenames are terminated with NUL instead of line break
     status_iter = iter(cp.stdout.split('\x00')[:-1])
     for entry in status_iter:
         if entry[0] == 'R':
@@ -171,6 +249,12 @@ def has_this_repo_changed(ignored_file=None):
     return False
 
 
+# the branch of other_repo that goes with the given branch of repo (e.g., EMF's alpha with SWMH-BETA's master)
+def paired_branch(repo, branch, other_repo):
+    branches = g_repos[other_repo]
+    return branches[min(g_repos[repo].index(branch), len(branches) - 1)]
+
+
 def load_state():
     global g_ignored_rev
     g_ignored_rev = {}
@@ -236,162 +320,139 @@ def should_rebuild_sed(repo, branch, changed_files):
 def rebuild_emf(repo, branch, rev):
     assert repo == 'EMF' or repo == 'SWMH-BETA', 'unsupported trigger repository: ' + repo
     logging.info('rebuilding EMF...')
-    # get on the right branches
-    emf_branch = g_repos['EMF'][g_repos[repo].index(branch)]
-    swmh_branch = g_repos['SWMH-BETA'][g_repos[repo].index(branch)]
-    os.chdir(str(g_root_repo_dir / 'SWMH-BETA'))
-    git_run(['checkout', swmh_branch])
-    os.chdir(str(g_root_repo_dir / 'ck2utils'))
-    git_run(['checkout', 'dev'])
-    os.chdir(str(g_root_repo_dir / 'EMF'))
-    git_run(['checkout', emf_branch])
+    # the heads we use (see task_checkouts) are each in their own worktree
+    emf_branch = paired_branch(repo, branch, 'EMF')
+    repo_dir = str(head_dir('EMF', emf_branch))
 
     cp = subprocess.run(['/usr/bin/python3', 'src/rebuild_managed.py'],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=repo_dir)
 
     if cp.returncode != 0:
         logging.error('failed to rebuild EMF:\n>command: {}\n>code: {}\n>error:\n{}\n'
                       .format(cp.args, cp.returncode, cp.stderr))
-        git_run(['reset', '--hard', 'HEAD'])
-        git_run(['clean', '-df'])
-        os.chdir(str(g_base_dir))
+        git_run(['reset', '--hard', 'HEAD'], cwd=repo_dir)
+        git_run(['clean', '-df'], cwd=repo_dir)
         slack_errmsg("to rebuild auto-managed files in `EMF/{}`".format(emf_branch), repo, branch, cp.args, cp.returncode, cp.stderr, rev)
         raise RebuildFailedException()
 
     # did anything change besides our version.txt?
     version_file = 'EMF/version.txt'
-    if not has_this_repo_changed(ignored_file=version_file):
+    if not has_this_repo_changed(repo_dir, ignored_file=version_file):
         # eh, no biggie-- cleanup version.txt and go
-        git_run(['checkout', version_file])
-        os.chdir(str(g_base_dir))
+        git_run(['checkout', version_file], cwd=repo_dir)
         return None
 
     # if we're here, we do indeed have changes to commit.
-    git_run(['add', '-A'])
-    git_run(['commit', '-a', '-m', 'rebuilt managed files :robot_face:'])
+    git_run(['add', '-A'], cwd=repo_dir)
+    git_run(['commit', '-a', '-m', 'rebuilt managed files :robot_face:'], cwd=repo_dir)
 
     # determine the head's new SHA so that we may ignore it for future processing
-    new_rev = git_run(['rev-parse', 'HEAD']).stdout.strip()
+    new_rev = git_run(['rev-parse', 'HEAD'], cwd=repo_dir).stdout.strip()
     g_ignored_rev[repo + ':' + branch] = new_rev
 
     # .. and puuuuush, deep breaths
-    git_run(['push'], retry=True)
+    git_run(['push'], retry=True, cwd=repo_dir)
 
     # ta-dah!
     logging.info('rebuild of EMF resulted in net change. pushed new EMF (%s)', new_rev)
-    os.chdir(str(g_base_dir))
     return new_rev
 
 
 def rebuild_mini(repo, branch, rev):
     assert repo == 'SWMH-BETA', 'rebuild_mini: unsupported repo: ' + repo
     logging.info('rebuilding MiniSWMH...')
-    # get on the right branches
-    mini_branch = g_repos['MiniSWMH'][g_repos[repo].index(branch)]
-    swmh_branch = g_repos['SWMH-BETA'][g_repos[repo].index(branch)]
-    os.chdir(str(g_root_repo_dir / 'SWMH-BETA'))
-    git_run(['checkout', swmh_branch])
-    os.chdir(str(g_root_repo_dir / 'ck2utils'))
-    git_run(['checkout', 'dev'])
-    os.chdir(str(g_root_repo_dir / 'MiniSWMH'))
-    git_run(['checkout', mini_branch])
-
-    cp = subprocess.run(['/usr/bin/python3', 'build_mini.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    # the heads we use (see task_checkouts) are each in their own worktree
+    mini_branch = paired_branch(repo, branch, 'MiniSWMH')
+    repo_dir = str(head_dir('MiniSWMH', mini_branch))
+
+    cp = subprocess.run(['/usr/bin/python3', 'build_mini.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=repo_dir)
 
     if cp.returncode != 0:
         logging.error('failed to rebuild MiniSWMH:\n>command: {}\n>code: {}\n>error:\n{}\n'.format(cp.args, cp.returncode, cp.stderr))
-        git_run(['reset', '--hard', 'HEAD'])
-        git_run(['clean', '-df'])
-        os.chdir(str(g_base_dir))
+        git_run(['reset', '--hard', 'HEAD'], cwd=repo_dir)
+        git_run(['clean', '-df'], cwd=repo_dir)
         slack_errmsg("to auto-update `MiniSWMH/{}`".format(mini_branch), repo, branch, cp.args, cp.returncode, cp.stderr, rev)
         raise RebuildFailedException()
 
     # did anything change besides our version.txt?
     version_file = 'MiniSWMH/version.txt'
-    if not has_this_repo_changed(ignored_file=version_file):
+    if not has_this_repo_changed(repo_dir, ignored_file=version_file):
         # eh, no biggie-- cleanup version.txt and go
-        git_run(['checkout', version_file])
-        os.chdir(str(g_base_dir))
+        git_run(['checkout', version_file], cwd=repo_dir)
         return None
 
     # if we're here, we do indeed have changes to commit.
-    git_run(['add', '-A'])
-    git_run(['commit', '-a', '-m', 'rebuild from upstream changes :robot_face:'])
+    git_run(['add', '-A'], cwd=repo_dir)
+    git_run(['commit', '-a', '-m', 'rebuild from upstream changes :robot_face:'], cwd=repo_dir)
 
     # determine the head's new SHA so that we may ignore it for future processing
-    new_rev = git_run(['rev-parse', 'HEAD']).stdout.strip()
+    new_rev = git_run(['rev-parse', 'HEAD'], cwd=repo_dir).stdout.strip()
     g_ignored_rev['MiniSWMH:' + mini_branch] = new_rev
 
     # .. and puuuuush, deep breaths
-    git_run(['push'], retry=True)
+    git_run(['push'], retry=True, cwd=repo_dir)
 
     # ta-dah!
     logging.info('rebuild of MiniSWMH resulted in net change. pushed new MiniSWMH (%s)', new_rev)
-    os.chdir(str(g_base_dir))
     return new_rev
 
 
 def rebuild_sed(repo, branch, rev):
     logging.info('rebuilding sed2...')
 
-    # get on the right branches
-    sed_branch = g_repos['sed2'][g_repos[repo].index(branch)]
-    emf_branch = g_repos['EMF'][g_repos[repo].index(branch)]
-    mini_branch = g_repos['MiniSWMH'][g_repos[repo].index(branch)]
-    swmh_branch = g_repos['SWMH-BETA'][g_repos[repo].index(branch)]
-    os.chdir(str(g_root_repo_dir / 'SWMH-BETA'))
-    git_run(['checkout', swmh_branch])
-    os.chdir(str(g_root_repo_dir / 'MiniSWMH'))
-    git_run(['checkout', mini_branch])
-    os.chdir(str(g_root_repo_dir / 'EMF'))
-    git_run(['checkout', emf_branch])
-    os.chdir(str(g_root_repo_dir / 'sed2'))
-    git_run(['checkout', sed_branch])
-
-    cp = subprocess.run(['/usr/bin/python3', 'build.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    # the heads we use (see task_checkouts) are each in their own worktree
+    sed_branch = paired_branch(repo, branch, 'sed2')
+    repo_dir = str(head_dir('sed2', sed_branch))
+
+    cp = subprocess.run(['/usr/bin/python3', 'build.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=repo_dir)
 
     if cp.returncode != 0:
         logging.error('failed to rebuild sed2:\n>command: {}\n>code: {}\n>error:\n{}\n'.format(cp.args, cp.returncode, cp.stderr))
-        git_run(['reset', '--hard', 'HEAD'])
-        git_run(['clean', '-df'])
-        os.chdir(str(g_base_dir))
+        git_run(['reset', '--hard', 'HEAD'], cwd=repo_dir)
+        git_run(['clean', '-df'], cwd=repo_dir)
         slack_errmsg("to auto-update SED (`sed2/{}`)".format(sed_branch), repo, branch, cp.args, cp.returncode, cp.stderr, rev)
         raise RebuildFailedException()
 
     # did anything change besides our version.txt?
     version_file = 'build/SED2/version.txt'
-    if not has_this_repo_changed(ignored_file=version_file):
+    if not has_this_repo_changed(repo_dir, ignored_file=version_file):
         # eh, no biggie-- cleanup version.txt and go
-        git_run(['checkout', version_file])
-        os.chdir(str(g_base_dir))
+        git_run(['checkout', version_file], cwd=repo_dir)
         return None
 
     # if we're here, we do indeed have changes to commit.
-    git_run(['add', '-A'])
-    git_run(['commit', '-a', '-m', 'rebuild from upstream changes :robot_face:'])
+    git_run(['add', '-A'], cwd=repo_dir)
+    git_run(['commit', '-a', '-m', 'rebuild from upstream changes :robot_face:'], cwd=repo_dir)
 
     # determine the head's new SHA so that we may ignore it for future processing
-    new_rev = git_run(['rev-parse', 'HEAD']).stdout.strip()
+    new_rev = git_run(['rev-parse', 'HEAD'], cwd=repo_dir).stdout.strip()
     g_ignored_rev['sed2:' + sed_branch] = new_rev
 
     # .. and puuuuush, deep breaths
-    git_run(['push'], retry=True)
+    git_run(['push'], retry=True, cwd=repo_dir)
 
     # ta-dah!
     logging.info('rebuild of sed2 resulted in net change. pushed new sed2 (%s).', new_rev)
-    os.chdir(str(g_base_dir))
     return new_rev
 
 
+def cksum_file(path, hash_name):
+    if hash_name == 'blake2b':
+        cksum = hashlib.blake2b(digest_size=16)
+    else:
+        cksum = hashlib.new(hash_name)
+    with path.open('rb') as f:
+        for buf in iter(lambda: f.read(1 << 20), b''):
+            cksum.update(buf)
+    return cksum.hexdigest()
+
+
 def process_emf_beta():
     logging.info('processing new EMF/beta...')
-    emf_dir = g_root_repo_dir / 'EMF'
-    os.chdir(str(emf_dir))
-    git_run(['checkout', 'beta'])
+    emf_dir = head_dir('EMF', 'beta')
 
     logging.info('updating public EMF beta and cumulative release changelogs...')
-    cp = subprocess.run(['/usr/bin/perl', str(g_root_repo_dir / 'HIP-tools/hiphub/update_emf_changelogs.pl')], stderr=subprocess.PIPE, universal_newlines=True)
-    os.chdir(str(g_base_dir))
+    cp = subprocess.run(['/usr/bin/perl', str(head_dir('HIP-tools', 'master') / 'hiphub/update_emf_changelogs.pl')], stderr=subprocess.PIPE, universal_newlines=True, cwd=str(emf_dir))
 
     if cp.returncode != 0:
         logging.error('failed to update public EMF changelogs:\n>command: {}\n>code: {}\n>error:\n{}\n'.format(cp.args, cp.returncode, cp.stderr))
@@ -434,13 +495,13 @@ def process_emf_beta():
         for i in files:
             full_path = Path(root) / i
             virt_path = full_path.relative_to(staging_dir)
-            cksum = hashlib.md5()
-            with full_path.open('rb') as f:
-                cksum.update(f.read())
-            path_cksum[virt_path] = cksum.hexdigest()
+            path_cksum[virt_path] = cksum_file(full_path, g_emfbeta_hash)
 
     with manifest_path.open('w') as f:
-        print('time: {}'.format(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')), file=f)
+        header = 'time: {}'.format(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        if g_emfbeta_hash != 'md5':  # MD5 manifests keep the version 1 header, which older installers understand
+            header += ' // version: {} // hash: {}'.format(g_manifest_version, g_emfbeta_hash)
+        print(header, file=f)
         for p in sorted(path_cksum):
             print('{} // {}'.format(p, path_cksum[p]), file=f)
 
@@ -455,15 +516,13 @@ def process_emf_beta():
     if zip_tmp_path.exists():
         zip_tmp_path.unlink()
 
-    os.chdir(str(staging_dir))
     zip_cmd = [str(g_zipbin_path), '-q', '-r', '-o', str(zip_tmp_path), './']
 
-    cp = subprocess.run(zip_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    cp = subprocess.run(zip_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, cwd=str(staging_dir))
 
     if cp.returncode != 0:
         logging.error('failed to archive EMF beta staging folder:\n>command: {}\n>code: {}\n>output:\n{}\n'.format(cp.args, cp.returncode, cp.stdout))
         slack_errmsg("to update the EMF beta while trying to archive its staging folder", cmd=cp.args, rc=cp.returncode, stderr=cp.stdout)
-        os.chdir(str(g_base_dir))
         return
 
     end_zip_time = time.time()
@@ -473,23 +532,20 @@ def process_emf_beta():
 
     zip_tmp_path.replace(g_emfbeta_path)
     logging.info('atomically updated public EMF beta archive -- done!')
-    os.chdir(str(g_base_dir))
 
 
 def check_save_compat(repo, branch, rev):
     assert repo == 'SWMH-BETA', 'check_save_compat: unsupported repo: ' + repo
     logging.info('checking save compatibility for SWMH...')
-    # get on the right branch
-    os.chdir(str(g_root_repo_dir / 'SWMH-BETA'))
-    git_run(['checkout', branch])
+    # SWMH-BETA's worktree is only read here (others may be reading it too), so there's nothing to clean up upon
+    # failure.
+    repo_dir = head_dir('SWMH-BETA', branch)
+    ck2utils_dir = head_dir('ck2utils', paired_branch(repo, branch, 'ck2utils'))
 
-    cp = subprocess.run(['/usr/bin/python3', str(g_root_repo_dir / 'ck2utils/esc/save_compat.py'), str(g_root_repo_dir / 'SWMH-BETA/SWMH')], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    cp = subprocess.run(['/usr/bin/python3', str(ck2utils_dir / 'esc/save_compat.py'), str(repo_dir / 'SWMH')], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=str(repo_dir))
 
     if cp.returncode != 0:
         logging.error('failed to check save compatibility for SWMH:\n>command: {}\n>code: {}\n>error:\n{}\n'.format(cp.args, cp.returncode, cp.stderr))
-        git_run(['reset', '--hard', 'HEAD'])
-        git_run(['clean', '-df'])
-        os.chdir(str(g_base_dir))
         slack_errmsg("to complete SWMH save-compatibility check", repo, branch, cp.args, cp.returncode, cp.stderr, rev)
         raise RebuildFailedException()
 
@@ -499,10 +555,75 @@ def check_save_compat(repo, branch, rev):
         if len(result) > 200:
             result = result[:200] + " [...]"
         slack.isis_sendmsg(":shakefist: SWMH-BETA:{} {}".format(branch, result), channel='#github')
-    os.chdir(str(g_base_dir))
     return compatible
 
 
+# processing tasks for a push to each repo, in the order in which they'd run one after another
+g_head_tasks = {
+    'SWMH-BETA': [rebuild_mini, rebuild_sed, rebuild_emf, check_save_compat],
+    'MiniSWMH': [rebuild_sed],
+    'EMF': [rebuild_emf],
+}
+
+# repos whose heads' worktrees each task reads (False) or writes (True)
+g_task_repos = {
+    rebuild_mini: {'SWMH-BETA': False, 'ck2utils': False, 'MiniSWMH': True},
+    rebuild_sed: {'SWMH-BETA': False, 'MiniSWMH': False, 'EMF': False, 'sed2': True},
+    rebuild_emf: {'SWMH-BETA': False, 'ck2utils': False, 'EMF': True},
+    check_save_compat: {'SWMH-BETA': False, 'ck2utils': False},
+}
+
+# repos whose worktrees any processing uses (see g_task_repos and process_emf_beta). the worktrees of other repos
+# are left alone, as only their heads' SHAs matter.
+g_worktree_repos = {r for repos in g_task_repos.values() for r in repos} | {'EMF', 'HIP-tools'}
+
+
+# a task's (or job's) checkouts map each (repo, branch) whose worktree it uses to whether it writes to it. the
+# branches are those paired with the triggering head's.
+def task_checkouts(task, repo, branch):
+    return {(r, paired_branch(repo, branch, r)): w for r, w in g_task_repos[task].items()}
+
+
+# a job updates its head's worktree and then may run any of its processing tasks
+def job_checkouts(repo, branch):
+    checkouts = {(repo, branch): True}
+    if repo == 'EMF' and branch == 'beta':  # see process_head_change
+        checkouts[('HIP-tools', 'master')] = False  # for update_emf_changelogs.pl
+        return checkouts
+    for task in g_head_tasks.get(repo, []):
+        for h, w in task_checkouts(task, repo, branch).items():
+            checkouts[h] = checkouts.get(h, False) or w
+    return checkouts
+
+
+# work which uses the same worktree conflicts unless both only read it
+def checkouts_conflict(a, b):
+    return any(a[h] or b[h] for h in a.keys() & b.keys())
+
+
+# runs the tasks (task function, checkouts) with args, concurrently where they don't conflict, and otherwise in the
+# given order. a task waits for every earlier task it conflicts with, so turnaround is that of the longest chain of
+# them. returns whether all of the tasks succeeded.
+def run_task_graph(tasks, *args):
+    deps = [{j for j in range(i) if checkouts_conflict(tasks[i][1], tasks[j][1])} for i in range(len(tasks))]
+    failed = False
+    done = set()
+    running = {}  # future => task index
+    with concurrent.futures.ThreadPoolExecutor(max_workers=g_max_workers) as pool:
+        while len(done) < len(tasks):
+            for i, (task, checkouts) in enumerate(tasks):
+                if i not in done and i not in running.values() and deps[i] <= done:
+                    running[pool.submit(task, *args)] = i
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                done.add(running.pop(f))
+                try:
+                    f.result()
+                except RebuildFailedException:
+                    failed = True
+    return not failed
+
+
 def process_head_change(repo, branch, head_rev):
     head = '{}:{}'.format(repo, branch)
     do_processing = True
@@ -525,7 +646,7 @@ def process_head_change(repo, branch, head_rev):
         should_check_compat = False
 
         if repo in ['SWMH-BETA', 'MiniSWMH', 'EMF'] and head in g_last_rev:
-            changed_files = git_files_changed(repo, branch, g_last_rev[head])
+            changed_files = git_files_changed(repo, branch, g_last_rev[head], head_rev)
 
         if repo == 'SWMH-BETA':
             should_check_compat = True
@@ -542,26 +663,10 @@ def process_head_change(repo, branch, head_rev):
         elif repo == 'EMF':
             build_emf = (head not in g_last_rev) or should_rebuild_emf(repo, branch, changed_files)
 
-        if build_mini:
-            try:
-                rebuild_mini(repo, branch, head_rev)
-            except RebuildFailedException:
-                processing_failed = True
-        if build_sed:
-            try:
-                rebuild_sed(repo, branch, head_rev)
-            except RebuildFailedException:
-                processing_failed = True
-        if build_emf:
-            try:
-                rebuild_emf(repo, branch, head_rev)
-            except RebuildFailedException:
-                processing_failed = True
-        if should_check_compat:
-            try:
-                check_save_compat(repo, branch, head_rev)
-            except RebuildFailedException:
-                processing_failed = True
+        wanted = {rebuild_mini: build_mini, rebuild_sed: build_sed, rebuild_emf: build_emf,
+                  check_save_compat: should_check_compat}
+        tasks = [(t, task_checkouts(t, repo, branch)) for t in g_head_tasks.get(repo, []) if wanted[t]]
+        processing_failed = not run_task_graph(tasks, repo, branch, head_rev)
 
     if not processing_failed:  # don't advance last-processed rev for this head unless all of its processing tasks completed OK
         # update memory state
@@ -572,6 +677,91 @@ def process_head_change(repo, branch, head_rev):
             print(head_rev, file=f)
 
 
+# the job queue has (at most) one job per head. another push to a head that's already queued just moves the job's
+# `after` SHA forward, so a burst of pushes to a head is processed once. jobs are only removed once processed, so
+# any left over from a crash are processed upon restart.
+def open_job_queue():
+    global g_queue
+    g_queue = sqlite3.connect(str(g_queue_path), isolation_level=None)  # autocommit; each statement is atomic
+    # seq counts the pushes to a job's head since it was queued (see finish_job)
+    g_queue.execute('CREATE TABLE IF NOT EXISTS jobs (repo TEXT NOT NULL, branch TEXT NOT NULL, before TEXT, '
+                    'after TEXT, queued REAL NOT NULL, seq INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (repo, branch))')
+    n_jobs = g_queue.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+    if n_jobs:
+        logging.info('replaying %d job(s) left in the queue', n_jobs)
+
+
+def enqueue_job(repo, branch, before=None, after=None):
+    g_queue.execute('INSERT INTO jobs (repo, branch, before, after, queued) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (repo, branch) DO UPDATE SET before = COALESCE(before, excluded.before), '
+                    'after = COALESCE(excluded.after, after), seq = seq + 1',
+                    (repo, branch, before, after, time.time()))
+
+
+# if seq is given, the job is only removed if there have been no more pushes to its head since it was dequeued
+def finish_job(repo, branch, seq=None):
+    if seq is None:
+        g_queue.execute('DELETE FROM jobs WHERE repo = ? AND branch = ?', (repo, branch))
+    else:
+        g_queue.execute('DELETE FROM jobs WHERE repo = ? AND branch = ? AND seq = ?', (repo, branch, seq))
+
+
+def repo_rank(repo):  # length of the longest chain of repos that repo's processing depends upon
+    return max((1 + repo_rank(r) for r in g_repo_deps.get(repo, [])), default=0)
+
+
+# returns the queued jobs as (repo, branch, before, after, seq) tuples, upstream repos first (so that, e.g., a
+# rebuild of sed2 sees the new MiniSWMH), and then in order of arrival. jobs for heads no longer tracked are dropped.
+def order_jobs():
+    jobs = []
+    for repo, branch, before, after, queued, seq in g_queue.execute(
+            'SELECT repo, branch, before, after, queued, seq FROM jobs'):
+        if branch not in g_repos.get(repo, []):
+            logging.info('dropping queued job for untracked head: %s/%s', repo, branch)
+            finish_job(repo, branch)
+            continue
+        jobs.append( (repo_rank(repo), queued, repo, branch, before, after, seq) )
+    return [j[2:] for j in sorted(jobs)]
+
+
+def process_job(repo, branch, after):
+    rev = update_head(repo, branch, after)
+    if after is not None and rev != after:
+        logging.debug('head %s/%s is at %s rather than pushed %s (pushed to again since?)', repo, branch, rev, after)
+    if rev == g_last_rev.get('{}:{}'.format(repo, branch)):
+        logging.debug('skipped processing of head (unchanged): %s/%s at rev %s', repo, branch, rev)
+        return
+    if repo in g_worktree_repos:
+        sync_worktree(repo, branch, rev)
+    process_head_change(repo, branch, rev)
+
+
+# processes queued jobs until there are none left. jobs run concurrently unless their checkouts (see job_checkouts)
+# conflict, in which case they run in queue order. webhook events that arrive meanwhile are queued as they come
+# (within a second), so that they're ordered with the rest; a job is run again if its head is pushed to while
+# it's running.
+def process_jobs(fifo_fd=None):
+    running = {}  # future => (repo, branch, seq, checkouts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=g_max_workers) as pool:
+        while True:
+            if fifo_fd is not None:
+                queue_webhook_events(wait_webhook_events(fifo_fd, 0))
+            blocked = [job[3] for job in running.values()]
+            for repo, branch, before, after, seq in order_jobs():
+                checkouts = job_checkouts(repo, branch)
+                if not any(checkouts_conflict(checkouts, c) for c in blocked):
+                    future = pool.submit(process_job, repo, branch, after)
+                    running[future] = (repo, branch, seq, checkouts)
+                blocked.append(checkouts)  # later jobs which conflict with this one must wait for it
+            if not running:
+                return
+            finished, _ = concurrent.futures.wait(running, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                repo, branch, seq, _ = running.pop(f)
+                f.result()  # anything but a failed rebuild (handled within) is fatal, as it was before
+                finish_job(repo, branch, seq)
+
+
 def init_daemon():
     # mark our tracks with pidfile
     with g_pidfile_path.open('w') as f:
@@ -584,6 +774,9 @@ def init_daemon():
     if not g_state_dir.exists():
         logging.debug('state folder does not exist, creating: {}'.format(g_state_dir))
         g_state_dir.mkdir(parents=True)
+    if not g_worktree_dir.exists():
+        logging.debug('worktree folder does not exist, creating: {}'.format(g_worktree_dir))
+        g_worktree_dir.mkdir(parents=True)
 
     # reset our environment to something appropriate for the `g_daemon_user`
     env_vars_to_del = ['LOGNAME', 'LS_COLORS', 'SUDO_GID', 'SUDO_UID', 'SUDO_USER', 'SUDO_COMMAND',
@@ -609,56 +802,131 @@ def init_daemon():
     logging.debug(env_dump)
 
     load_state()
+    open_job_queue()
+    init_worktrees()
 
+    # every head may have been pushed to while we weren't running, so fetch all of the repos (at once) and queue
+    # the heads which have changed since they were last processed
     logging.debug('updating all tracked heads...')
-    proc_needed = []
-
+    fetch_repos(list(g_repos))
     for repo in g_repos:
         for branch in g_repos[repo]:
-            rev = update_head(repo, branch)
-            h = '{}:{}'.format(repo, branch)
-            if rev != g_last_rev.get(h):
-                proc_needed.append( (repo, branch, rev) )
+            last_rev = g_last_rev.get('{}:{}'.format(repo, branch))
+            rev = g_remote_revs[(repo, branch)]
+            if rev != last_rev:
+                enqueue_job(repo, branch, last_rev, rev)
+
+    process_jobs()
 
-    # TODO: might want to sort proc_needed so that, e.g., SWMH-BETA < MiniSWMH < EMF
 
-    for pn in proc_needed:
-        process_head_change(*pn)
+# creates the folder of the webhook FIFO. only root can write to /run, so this is done before dropping privileges.
+# if it fails, open_webhook_fifo() will say so and we'll fall back to polling.
+def make_webhook_fifo_dir(uid, gid):
+    try:
+        g_webhook_fifo_dir.mkdir(exist_ok=True)
+        os.chown(str(g_webhook_fifo_dir), uid, gid)
+        os.chmod(str(g_webhook_fifo_dir), 0o710)
+    except OSError:
+        pass
 
 
-def run_daemon():
-    last_mtime = {}
+# the webhook writes a line to our FIFO for every push, but only while we have it open for reading, so we
+# create it if need be and open it for the lifetime of the daemon. returns its fd, or None if it can't be used.
+def open_webhook_fifo():
+    path = str(g_webhook_fifo_path)
+    try:
+        if not g_webhook_fifo_path.exists():
+            os.mkfifo(path)
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            logging.warning('not a FIFO, so falling back to polling for webhook events: %s', path)
+            return None
+        os.chmod(path, 0o620)  # only our group may write to it (so the webhook, as the web server's user, can)
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # hold the write end open too, else the read end is at EOF (always readable) whenever no webhook has it open
+        os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        logging.warning('failed to open webhook FIFO, so falling back to polling for webhook events: %s', e)
+        return None
+    logging.debug('listening for webhook events on %s', path)
+    return fd
+
+
+g_webhook_fifo_buf = b''  # incomplete line read from the FIFO so far
 
+
+# blocks until the webhook sends us events or the timeout (seconds) passes, and returns the events received as
+# (repo, branch, before, after) tuples, oldest first. each event is a line of the form 'repo:branch before after'.
+def wait_webhook_events(fifo_fd, timeout):
+    global g_webhook_fifo_buf
+    if fifo_fd is None:
+        time.sleep(timeout)
+        return []
+    readable, _, _ = select.select([fifo_fd], [], [], timeout)
+    if not readable:
+        return []
+    try:
+        g_webhook_fifo_buf += os.read(fifo_fd, 1 << 16)
+    except BlockingIOError:
+        return []
+    *lines, g_webhook_fifo_buf = g_webhook_fifo_buf.split(b'\n')
+    events = []
+    for line in lines:
+        try:
+            h, before, after = line.decode().split()
+            r, b = h.split(':', 1)
+        except ValueError:
+            logging.warning('discarding malformed webhook event: %r', line)
+            continue
+        if b not in g_repos.get(r, []):
+            logging.debug('discarding webhook event for untracked head: %s/%s', r, b)
+            continue
+        events.append( (r, b, before, after) )
+    return events
+
+
+g_last_mtime = {}  # mtime of each head's file in the webhook folder as of its last push event
+
+
+def queue_webhook_events(events):
+    for r, b, before, after in events:
+        logging.debug('webhook received push event: %s/%s (%s..%s)', r, b, before, after)
+        enqueue_job(r, b, before, after)
+        # the webhook writes the head's file before the event, so polling needn't pick the push up again
+        h = '{}:{}'.format(r, b)
+        p = g_webhook_dir / h
+        if p.exists():
+            g_last_mtime[h] = p.stat().st_mtime
+
+
+def run_daemon():
     # initialize file mtimes
     for r in g_repos:
         for b in g_repos[r]:
             h = '{}:{}'.format(r, b)
             p = g_webhook_dir / h
             if p.exists():
-                last_mtime[h] = p.stat().st_mtime
+                g_last_mtime[h] = p.stat().st_mtime
 
-    while True:
-        time.sleep(1)  # one-second polling interval
-
-        changed_heads = []
-        for r in g_repos:
-            for b in g_repos[r]:
-                h = '{}:{}'.format(r, b)
-                p = g_webhook_dir / h
-                if p.exists() and (h not in last_mtime or p.stat().st_mtime > last_mtime[h]):
-                    logging.debug('webhook received push event: %s/%s', r, b)
-                    changed_heads.append( (r, b) )
-                    last_mtime[h] = p.stat().st_mtime
+    fifo_fd = open_webhook_fifo()
+    poll_interval = g_webhook_poll_interval if fifo_fd is not None else 1
+    next_poll_time = time.time() + poll_interval
 
-        proc_needed = []
-        for c in changed_heads:
-            rev = update_head(*c)
-            proc_needed.append( (*c, rev) )
+    while True:
+        queue_webhook_events(wait_webhook_events(fifo_fd, max(0, next_poll_time - time.time())))
 
-        # TODO: might want to sort proc_needed so that, e.g., SWMH-BETA < MiniSWMH < EMF
+        # fallback for pushes we weren't told of (e.g., sent while we weren't running or with the FIFO full)
+        if time.time() >= next_poll_time:
+            next_poll_time = time.time() + poll_interval
+            for r in g_repos:
+                for b in g_repos[r]:
+                    h = '{}:{}'.format(r, b)
+                    p = g_webhook_dir / h
+                    if p.exists() and (h not in g_last_mtime or p.stat().st_mtime > g_last_mtime[h]):
+                        logging.debug('webhook push event found by polling: %s/%s', r, b)
+                        enqueue_job(r, b)
+                        g_last_mtime[h] = p.stat().st_mtime
 
-        for pn in proc_needed:
-            process_head_change(*pn)
+        process_jobs(fifo_fd)
 
 
 def shutdown_daemon(exit_code=0):
@@ -720,6 +988,7 @@ def main():
     pwent = pwd.getpwnam(g_daemon_user)
     context.uid = pwent[2]
     context.gid = pwent[3]
+    make_webhook_fifo_dir(context.uid, context.gid)
 
     if g_pidfile_path.exists():
         if opt_restart:
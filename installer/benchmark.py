@@ -0,0 +1,93 @@
+#!python2
+
+# Microbenchmarks for the installer's hot paths. Not shipped in HIP.7z.
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+import time
+
+import main
+
+
+def legacyUnwrapBuffer(buf, length):  # The original per-byte loop, as reference
+    kN = len(main.g_k)
+    for i in range(length):
+        buf[i] ^= main.g_k[i % kN]
+
+
+def throughput(f, data, minTime):
+    n = 0
+    elapsed = 0.0
+    while True:
+        buf = bytearray(data)
+        startTime = time.time()
+        f(buf, len(buf))
+        elapsed += time.time() - startTime
+        n += 1
+        if elapsed >= minTime:
+            return buf, (len(data) * n / (1 << 20)) / elapsed
+
+
+def benchUnwrap(args):
+    if args.pure:
+        main.g_unwrapEngine = 'pure'
+        main.unwrapBlock = main.unwrapBlockPure
+    sizes = [(1 << 10, '1KB'), (1 << 12, '4KB'), (1 << 20, '1MB'), (50 << 20, '50MB')]
+    print('unwrap engine: {}'.format(main.g_unwrapEngine))
+    print('{:>6}  {:>12}  {:>12}  {:>8}'.format('size', 'loop MB/s', 'bulk MB/s', 'speedup'))
+    for size, label in sizes:
+        data = bytearray(os.urandom(size))
+        legacyBuf, legacyRate = throughput(legacyUnwrapBuffer, data, args.min_time)
+        bulkBuf, bulkRate = throughput(main.unwrapBuffer, data, args.min_time)
+        if legacyBuf != bulkBuf:
+            sys.stderr.write('output mismatch at size {}\n'.format(label))
+            return 1
+        print('{:>6}  {:>12.2f}  {:>12.2f}  {:>7.1f}x'.format(label, legacyRate, bulkRate, bulkRate / legacyRate))
+    return 0
+
+
+# Total time to checksum every file under a modules/ folder with each of the
+# manifest checksum algorithms available here. Files are read once beforehand so
+# that every algorithm sees the same warm OS cache.
+def benchCksum(args):
+    paths = []
+    for root, dirs, files in os.walk(args.modules_dir):
+        paths += [os.path.join(root, f) for f in files]
+    if not paths:
+        sys.stderr.write('no files found under {}\n'.format(args.modules_dir))
+        return 1
+    nBytes = 0
+    for p in paths:
+        nBytes += os.path.getsize(p)
+        main.hashFile(p, main.WRAP_NONE, 'crc32')
+    print('{} files, {:.1f}MB'.format(len(paths), nBytes / (1 << 20)))
+    print('{:>8}  {:>10}  {:>10}'.format('hash', 'seconds', 'MB/s'))
+    for hashName in sorted(main.g_hashes):
+        startTime = time.time()
+        for p in paths:
+            main.hashFile(p, main.WRAP_NONE, hashName)
+        elapsed = time.time() - startTime
+        print('{:>8}  {:>10.2f}  {:>10.1f}'.format(hashName, elapsed, nBytes / (1 << 20) / elapsed))
+    return 0
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Benchmark HIP installer hot paths.')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='minimum seconds to spend on each measurement')
+    subparsers = parser.add_subparsers(dest='bench')
+    unwrap = subparsers.add_parser('unwrap', help='compare bulk unwrapBuffer against the per-byte loop')
+    unwrap.add_argument('--pure', action='store_true',
+                        help='force the pure-Python engine even if NumPy is available')
+    cksum = subparsers.add_parser('cksum', help='time checksumming a modules/ folder with each algorithm')
+    cksum.add_argument('--modules-dir', default='modules',
+                       help='path to the modules/ folder to checksum')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = getArgs()
+    sys.exit({'unwrap': benchUnwrap, 'cksum': benchCksum}[args.bench](args))
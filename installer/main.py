@@ -2,13 +2,28 @@
 
 from __future__ import print_function
 
+import array
+import atexit
+import binascii
+import bisect
 import hashlib
+import json
+import multiprocessing
 import os
 import sys
 import shutil
+import struct
+import threading
 import traceback
 import time
 import re
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # Py2
+    import Queue as queue
 
 YES = 'yes'
 NO = 'no'
@@ -85,6 +100,49 @@ class InstallerPackageNotFoundError(InstallerException):
         return "The installer package files (modules/ folder) were not found!"
 
 
+class InstallerArgumentError(InstallerException):
+    def __init__(self, option):
+        self.option = option
+
+    def __str__(self):
+        return "Invalid value given for command-line option '%s'" % self.option
+
+
+class InstallerUnknownModuleError(InstallerException):
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return "Unknown module selected: '%s'" % self.name
+
+
+class InstallerSwapError(InstallerException):
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __str__(self):
+        return "Could not replace the preexisting '%s' (is a file in it open?), so it was left as it was" % self.folder
+
+
+class InstallerPackageDamagedError(InstallerException):
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "The installer package is damaged ('%s': %s). Please extract the HIP release archive again." % \
+               (self.path, self.reason)
+
+
+class InstallerPlanError(InstallerException):
+    def __init__(self, filename, reason):
+        self.filename = filename
+        self.reason = reason
+
+    def __str__(self):
+        return "Could not load the install plan '%s': %s" % (self.filename, self.reason)
+
+
 class NullDebugTrace:
     def __init__(self):
         pass
@@ -98,35 +156,168 @@ class NullDebugTrace:
     def pop(self, s=None):
         pass
 
+    def flush(self):
+        pass
+
 
+# Lines are buffered and written out in batches (and at exit), so that tracing
+# doesn't distort the install's timings. If sample is N > 1, only every Nth
+# trace() line is kept, though the push()/pop() lines always are.
 class DebugTrace(NullDebugTrace):
-    def __init__(self, f, prefix='DBG: '):
+    def __init__(self, f, prefix='DBG: ', sample=1):
         self.file = f
         self.prefix = prefix
+        self.sample = sample
         self.i = 0
+        self.n = 0
         self.indentStr = ' ' * 2
+        self.lines = []
+        atexit.register(self.flush)
+
+    def write(self, msg):
+        self.lines.append('{}{}{}\n'.format(self.indentStr * self.i, self.prefix, msg))
+        if len(self.lines) >= 1024:
+            self.flush()
 
-    def trace(self, msg):  # Trace msg to attached stream/file-like object with no output buffering
-        self.file.write('{}{}{}\n'.format(self.indentStr * self.i, self.prefix, msg))
+    def flush(self):
+        self.file.write(''.join(self.lines))
         self.file.flush()
+        del self.lines[:]
+
+    def trace(self, msg):  # Trace msg to attached stream/file-like object (sampled)
+        self.n += 1
+        if self.n % self.sample == 0:
+            self.write(msg)
 
     def push(self, s):  # Trace, then push indent stack
-        self.trace('{} {{'.format(s))
+        self.write('{} {{'.format(s))
         self.i += 1
 
     def pop(self, s=None):  # Pop indent stack
         if self.i <= 0:
             raise InstallerTraceNestingError()
         if s:
-            self.trace(s)
+            self.write(s)
         self.i -= 1
-        self.trace('}')
+        self.write('}')
+
+
+g_dbg = NullDebugTrace()
+
+# Wall-clock timer for profiling; time.perf_counter() is Py3.3+
+g_clock = getattr(time, 'perf_counter', time.time)
+
+# Statistics for compiling (or checksumming) a file: a list of the bytes read
+# and the seconds spent on each of the steps, indexed by these.
+STAT_BYTES  = 0
+STAT_READ   = 1
+STAT_HASH   = 2
+STAT_UNWRAP = 3
+STAT_WRITE  = 4
+g_compileStatNames = ['bytes', 'read', 'hash', 'unwrap', 'write']
+
+
+def newCompileStats():
+    return [0, 0.0, 0.0, 0.0, 0.0]
+
+
+def lapTime(stats, i, t):  # Adds the time since t to stats[i], returning the current time
+    now = g_clock()
+    stats[i] += now - t
+    return now
+
+
+# Times the installer's phases (accumulating over repeated start/stop pairs)
+# and totals the compile statistics (see newCompileStats) of the files of each
+# module, for the --profile timing report.
+class Profiler:
+    def __init__(self):
+        self.phases = []  # [name, seconds], in order of first start
+        self.startTimes = {}
+        self.compile = newCompileStats()
+        self.modules = {}  # Module folder => [files, skipped, compile stats]
+
+    def start(self, name):
+        self.startTimes[name] = g_clock()
+
+    def stop(self, name):
+        elapsed = g_clock() - self.startTimes.pop(name)
+        for phase in self.phases:
+            if phase[0] == name:
+                phase[1] += elapsed
+                break
+        else:
+            self.phases.append([name, elapsed])
+        return elapsed
+
+    def phaseTime(self, name):
+        for phaseName, elapsed in self.phases:
+            if phaseName == name:
+                return elapsed
+        return 0.0
+
+    def getModule(self, folder):
+        if folder not in self.modules:
+            self.modules[folder] = [0, 0, newCompileStats()]
+        return self.modules[folder]
+
+    def addCompile(self, folder, stats):
+        module = self.getModule(folder)
+        module[0] += 1
+        for i, x in enumerate(stats):
+            module[2][i] += x
+            self.compile[i] += x
+
+    def addSkip(self, folder):
+        self.getModule(folder)[1] += 1
+
+    # Writes the timing report to filename as JSON, along with the given info
+    # about the install (a dict), and prints a summary of it.
+    def report(self, filename, info):
+        def statsDict(stats):
+            d = dict((name, round(stats[i], 6)) for i, name in enumerate(g_compileStatNames))
+            d['bytes'] = stats[STAT_BYTES]
+            return d
+
+        compileTime = self.phaseTime('compile')
+        totals = statsDict(self.compile)
+        totals['files'] = sum(m[0] for m in self.modules.values())
+        totals['skipped'] = sum(m[1] for m in self.modules.values())
+        totals['mbPerSec'] = round(self.compile[STAT_BYTES] / float(1 << 20) / compileTime, 3) if compileTime else None
+        modules = {}
+        for folder, (files, skipped, stats) in self.modules.items():
+            modules[folder] = statsDict(stats)
+            modules[folder]['files'] = files
+            modules[folder]['skipped'] = skipped
+        report = dict(info)
+        report['phases'] = [{'name': name, 'seconds': round(elapsed, 6)} for name, elapsed in self.phases]
+        report['compile'] = totals
+        report['modules'] = modules
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        print('> Timing report ({}):'.format(filename))
+        for name, elapsed in self.phases:
+            print('  {:<14} {:8.2f} sec'.format(name, elapsed))
+        if totals['files']:
+            print('  Compiled {} files ({:.1f}MB) at {:.1f}MB/s; read {:.2f}, hash {:.2f}, unwrap {:.2f}, '
+                  'write {:.2f} sec (summed over workers).'.format(
+                  totals['files'], self.compile[STAT_BYTES] / float(1 << 20), totals['mbPerSec'] or 0.0,
+                  self.compile[STAT_READ], self.compile[STAT_HASH], self.compile[STAT_UNWRAP],
+                  self.compile[STAT_WRITE]))
+        print()
+
+
+g_prof = Profiler()
 
 
 WRAP_NONE  = 0
 WRAP_QUICK = 1
 WRAP_TOTAL = 2
 
+# Paths within module folders whose files are wrapped (see shrinkwrap.py)
+g_moduleWrapPaths = {'CPRplus': ['gfx']}
+
 
 class TargetSource:
     def __init__(self, folder, srcPath, isDir=False, wrap=WRAP_NONE):
@@ -136,6 +327,121 @@ class TargetSource:
         self.wrap = wrap
 
 
+def splitPath(p):
+    if os.altsep:
+        p = p.replace(os.altsep, os.sep)
+    return [c for c in p.split(os.sep) if c not in ('', '.')]
+
+
+# The virtual filesystem of target path => TargetSource that the selected
+# modules are merged into, layer over layer (one layer per pushFolder). It acts
+# like a dict, but it also indexes target paths in a trie of their components
+# so that whole subtrees can be looked up or removed in O(depth) plus the size
+# of the subtree, and it remembers what each path's source overrode.
+class TargetVFS:
+    def __init__(self):
+        self.entries = {}
+        self.trie = {}  # Nested dicts keyed by path component; key None holds the path of an entry
+        self.layers = []  # Module folder of each layer, in push order
+        self.overridden = {}  # Target path => TargetSources it overrode, oldest first
+
+    def pushLayer(self, folder):
+        self.layers.append(folder)
+
+    def node(self, path, create=False):
+        node = self.trie
+        for c in splitPath(path):
+            if c not in node:
+                if not create:
+                    return None
+                node[c] = {}
+            node = node[c]
+        return node
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __getitem__(self, path):
+        return self.entries[path]
+
+    def __setitem__(self, path, src):
+        src.layer = len(self.layers) - 1
+        if path in self.entries:
+            self.overridden.setdefault(path, []).append(self.entries[path])
+        else:
+            self.node(path, create=True)[None] = path
+        self.entries[path] = src
+
+    def __delitem__(self, path):
+        del self.entries[path]
+        self.overridden.pop(path, None)
+        components = splitPath(path)
+        nodes = [self.trie]
+        for c in components:
+            nodes.append(nodes[-1][c])
+        del nodes[-1][None]
+        for i in range(len(components) - 1, -1, -1):  # Prune now-empty nodes
+            if nodes[i + 1]:
+                break
+            del nodes[i][components[i]]
+
+    def get(self, path, default=None):
+        return self.entries.get(path, default)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def items(self):
+        return self.entries.items()
+
+    def values(self):
+        return self.entries.values()
+
+    # All paths in the subtree rooted at prefix (including prefix itself)
+    def paths(self, prefix):
+        node = self.node(prefix)
+        found = []
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            for c, child in node.items():
+                if c is None:
+                    found.append(child)
+                else:
+                    stack.append(child)
+        return found
+
+    # Removes the subtree rooted at prefix (including prefix itself), returning
+    # the paths removed.
+    def popTree(self, prefix):
+        removed = self.paths(prefix)
+        for p in removed:
+            del self.entries[p]
+            self.overridden.pop(p, None)
+        components = splitPath(prefix)
+        if components and removed:
+            del self.node(os.sep.join(components[:-1]))[components[-1]]
+        elif removed:
+            self.trie = {}
+        return removed
+
+    def owner(self, path):  # Module folder which the path's source comes from
+        src = self.entries.get(path)
+        return src.folder if src else None
+
+    def provenance(self, path):  # Module folders which provided the path, bottom layer first
+        return [s.folder for s in self.overridden.get(path, []) + [self.entries[path]]]
+
+
+g_targetSrc = TargetVFS()
+
+
 g_bannedFileExt = ['.pdn', '.psd', '.xcf', '.bak', '.tmp', '.rar', '.zip', \
                    '.7z', '.gz', '.tgz', '.xz', '.bz2', '.tar', '.ignore', \
                    '.xls', '.xlsx', '.xlsm', '.db']
@@ -207,6 +513,199 @@ def rmTree(f, traceMsg=None):
             rmFile(f)
 
 
+# For files written over ones which may have been compiled from a module: if
+# they were linked rather than copied, writing to them would write through to
+# the module's own files, so they're removed first.
+def rmLinkedFile(f):
+    if os.path.lexists(f):
+        rmFile(f)
+
+
+g_tombstonePrefix = '.hip_tombstone.'
+
+
+# Removes folders in the background. Each is first renamed aside to a tombstone
+# beside it, which is instant, and then deleted by a pool of daemon threads. If
+# the installer is killed first, what's left of the tombstone is reaped on the
+# next run.
+class Reaper:
+    def __init__(self, nThreads=4):
+        self.queue = queue.Queue()
+        self.nThreads = nThreads
+        self.threads = []
+        self.lock = threading.Lock()
+        self.n = 0
+        self.deferred = []  # (tombstone, path) pairs not yet queued for deletion
+
+    # Renames path to a tombstone, returning the tombstone's path, or None if it
+    # can't be renamed (e.g., a file in it is open on Windows).
+    def tombstone(self, path):
+        with self.lock:
+            n = self.n
+            self.n += 1
+        parent, name = os.path.split(path)
+        t = os.path.join(parent, '{}{}.{}.{}'.format(g_tombstonePrefix, name, os.getpid(), n))
+        try:
+            os.rename(path, t)
+        except OSError as e:
+            g_dbg.trace('failureTombstoning("{}", "{}")'.format(path, e))
+            return None
+        g_dbg.trace('tombstone("{}" => "{}")'.format(path, t))
+        return t
+
+    def bury(self, t):  # Queues the tombstone t for deletion
+        with self.lock:
+            if not self.threads:
+                for i in range(self.nThreads):
+                    thread = threading.Thread(target=self.work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(t)
+
+    def remove(self, path):  # Removes path in the background if possible, else right away
+        t = self.tombstone(path)
+        if t is None:
+            rmTree(path)
+        else:
+            self.bury(t)
+
+    # Tombstones path, but leaves it be until commit() so that rollback() can
+    # still restore it. Returns False if path couldn't be tombstoned.
+    def removeDeferred(self, path):
+        t = self.tombstone(path)
+        if t is None:
+            return False
+        self.deferred.append((t, path))
+        return True
+
+    def commit(self):  # Queues the deferred tombstones for deletion
+        for t, path in self.deferred:
+            self.bury(t)
+        self.deferred = []
+
+    def rollback(self):  # Renames the deferred tombstones back, replacing whatever is now at their paths
+        for t, path in reversed(self.deferred):
+            g_dbg.trace('rollbackTombstone("{}" => "{}")'.format(t, path))
+            try:
+                rmTree(path)
+                os.rename(t, path)
+            except OSError as e:  # Left as a tombstone, then
+                g_dbg.trace('failureRollingBackTombstone("{}")'.format(e))
+        self.deferred = []
+
+    def wait(self):  # Blocks until every tombstone queued so far is deleted
+        self.queue.join()
+
+    def work(self):  # No tracing here, as g_dbg isn't thread-safe
+        while True:
+            t = self.queue.get()
+            try:
+                shutil.rmtree(t, ignore_errors=True)
+            except Exception:  # e.g., the interpreter is shutting down under us
+                pass
+            self.queue.task_done()
+
+
+g_reaper = Reaper()
+
+
+# Queues any tombstones in folder left by a previous run for deletion, as well
+# as staging folders, which are tombstoned first to free up their names
+def reapTombstones(folder):
+    for e in os.listdir(folder):
+        path = os.path.join(folder, e)
+        if e.startswith(g_stagingPrefix):
+            g_reaper.remove(path)
+        elif e.startswith(g_tombstonePrefix):
+            g_dbg.trace('reapTombstone("{}")'.format(path))
+            g_reaper.bury(path)
+
+
+g_stagingPrefix = '.hip_staging.'
+g_stagedFolders = {}  # Target folder => staging folder
+
+
+# Has targetFolder compiled into a staging folder beside it instead, which
+# swapStagedFolders() then puts in its place.
+def stageFolder(targetFolder):
+    parent, name = os.path.split(targetFolder)
+    staging = os.path.join(parent, g_stagingPrefix + name)
+    rmTree(staging)
+    mkTree(staging)
+    g_stagedFolders[targetFolder] = staging
+    return staging
+
+
+# Where the target path p is really written: under its target folder's staging
+# folder, if it has one
+def stagedPath(p):
+    for targetFolder, staging in g_stagedFolders.items():
+        if p == targetFolder or p.startswith(targetFolder + os.sep):
+            return staging + p[len(targetFolder):]
+    return p
+
+
+def fsyncPath(p):
+    try:
+        fd = os.open(p, os.O_RDONLY if os.path.isdir(p) else os.O_RDWR)
+    except OSError:  # e.g., folders can't be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsyncTasks(tasks):  # Pool entry point; each task is a path
+    for p in tasks:
+        fsyncPath(p)
+    return []
+
+
+# Flushes the staging folders to disk in one batch before they're swapped in,
+# rather than every file as it's compiled. By then, the OS will have written
+# back most of it already.
+def syncStagedFolders(jobs):
+    g_dbg.push('syncStagedFolders')
+    tasks = []
+    for staging in g_stagedFolders.values():
+        for root, dirs, files in os.walk(staging):
+            tasks.extend(os.path.join(root, f) for f in files)
+            tasks.append(root)
+    for r in runPoolTasks(fsyncTasks, tasks, [], jobs):
+        pass
+    g_dbg.pop('numSynced({})'.format(len(tasks)))
+
+
+# Replaces each target folder with its staging folder, all or none of them.
+# The previous install is tombstoned, to be deleted once the caller commits
+# (see Reaper.removeDeferred). If a target folder can't be tombstoned or a
+# staging folder renamed into place, the folders swapped so far are put back
+# and the previous install restored; InstallerSwapError is raised in the former
+# case.
+def swapStagedFolders():
+    swapped = []
+    try:
+        for targetFolder, staging in sorted(g_stagedFolders.items()):
+            if os.path.exists(targetFolder) and not g_reaper.removeDeferred(targetFolder):
+                raise InstallerSwapError(targetFolder)
+            g_dbg.trace('swap("{}" => "{}")'.format(staging, targetFolder))
+            os.rename(staging, targetFolder)
+            swapped.append((targetFolder, staging))
+            fsyncPath(os.path.dirname(targetFolder) or '.')
+    except:
+        for targetFolder, staging in reversed(swapped):
+            g_dbg.trace('unswap("{}" => "{}")'.format(targetFolder, staging))
+            try:
+                os.rename(targetFolder, staging)
+            except OSError as e:  # rollback() will remove it, then
+                g_dbg.trace('failureUnswapping("{}")'.format(e))
+        g_reaper.rollback()
+        raise
+    g_stagedFolders.clear()
+
+
 def mkTree(d, traceMsg=None):
     if traceMsg:
         g_dbg.trace(traceMsg)
@@ -228,6 +727,7 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
         g_dbg.trace("MODULE_NOT_FOUND('{}')".format(folder))
         return
     g_dbg.push('pushModule("{}")'.format(srcFolder))
+    g_targetSrc.pushLayer(folder)
     ignoreFiles = {os.path.join(srcFolder, os.path.normpath(x)) for x in ignoreFiles}
     prunePaths = {os.path.join(srcFolder, os.path.normpath(x)) for x in prunePaths}
     wrapPaths = {os.path.join(srcFolder, os.path.normpath(x)) for x in wrapPaths}
@@ -235,6 +735,12 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
         g_dbg.trace('ignoredFile("{}")'.format(x))
     for x in prunePaths:
         g_dbg.trace('prunedPath("{}")'.format(x))
+    indexed = g_moduleIndex.folder(folder) if g_moduleIndex else None
+    if indexed is not None:
+        pushIndexedFolder(folder, srcFolder, targetFolder, indexed, ignoreFiles, prunePaths, wrapPaths)
+        g_dbg.pop()
+        return
+    wrappedDirs = set()
     for root, dirs, files in os.walk(srcFolder):
         newRoot = root.replace(srcFolder, targetFolder)
         g_dbg.push('pushDir("{}")'.format(root))
@@ -252,11 +758,12 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
                 newDir = os.path.join(newRoot, directory)
                 g_targetSrc[newDir] = TargetSource(folder, srcPath, isDir=True)
         dirs[:] = prunedDirs
+        files += g_blobStore.listDir(root)
         nPushed = 0
-        wrapped = False
-        for p in wrapPaths:
-            if root.startswith(p):
-                wrapped = True
+        # A directory is wrapped if it's in wrapPaths or its parent is wrapped (os.walk is top-down)
+        wrapped = root in wrapPaths or os.path.dirname(root) in wrappedDirs
+        if wrapped:
+            wrappedDirs.add(root)
         for f in files:
             src = os.path.join(root, f)
             dst = os.path.join(newRoot, f)
@@ -269,13 +776,49 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
             wrapType = WRAP_NONE
             if wrapped and not src.endswith('version.txt'):
                 wrapType = WRAP_QUICK if isFileQuickUnwrapped(src) else WRAP_TOTAL
-            g_targetSrc[dst] = TargetSource(folder, src, wrap=wrapType)
+            g_targetSrc[dst] = TargetSource(folder, g_blobStore.resolve(src), wrap=wrapType)
             nPushed += 1
         g_dbg.trace('numFilesPushed({})'.format(nPushed))
         g_dbg.pop()
     g_dbg.pop()
 
 
+# Pushes the dirs and files of a module folder as listed by the module index
+# rather than walking the filesystem, with the same semantics as pushFolder.
+def pushIndexedFolder(folder, srcFolder, targetFolder, indexed, ignoreFiles, prunePaths, wrapPaths):
+    dirs, files = indexed
+    g_dbg.trace('pushFromIndex(dirs={}, files={})'.format(len(dirs), len(files)))
+    nPushed = 0
+    # Both lists are sorted, so every directory comes before anything under it
+    prunedDirs = set()
+    wrappedDirs = set(wrapPaths)
+    for relPath in dirs:
+        srcPath = os.path.join(srcFolder, relPath)
+        parent = os.path.dirname(srcPath)
+        if srcPath in prunePaths or parent in prunedDirs:
+            if parent not in prunedDirs:
+                g_dbg.trace('pruneDir("{}")'.format(srcPath))
+            prunedDirs.add(srcPath)
+            continue
+        if parent in wrappedDirs:
+            wrappedDirs.add(srcPath)
+        g_targetSrc[os.path.join(targetFolder, relPath)] = TargetSource(folder, srcPath, isDir=True)
+    for relPath, quick in files:
+        src = os.path.join(srcFolder, relPath)
+        root = os.path.dirname(src)
+        if root in prunedDirs:
+            continue
+        if src in ignoreFiles:
+            g_dbg.trace('filteredFile("{}")'.format(src))
+            continue
+        wrapType = WRAP_NONE
+        if root in wrappedDirs and not src.endswith('version.txt'):
+            wrapType = WRAP_QUICK if quick else WRAP_TOTAL
+        g_targetSrc[os.path.join(targetFolder, relPath)] = TargetSource(folder, g_blobStore.resolve(src), wrap=wrapType)
+        nPushed += 1
+    g_dbg.trace('numFilesPushed({})'.format(nPushed))
+
+
 def popFile(f, targetFolder):
     f = os.path.normpath(f)
     p = os.path.join(targetFolder, f)
@@ -288,62 +831,558 @@ def popTree(d, targetFolder):
     d = os.path.normpath(d)
     t = os.path.join(targetFolder, d)
     g_dbg.push('popPathPrefix("{}")'.format(t))
-    for p in [p for p in g_targetSrc.keys() if p.startswith(t)]:
+    for p in sorted(g_targetSrc.popTree(t)):
         g_dbg.trace(p)
-        del g_targetSrc[p]
     g_dbg.pop()
 
 
 g_k  = bytearray(br'"The enemy of a good plan is the dream of a perfect plan" - Carl von Clausewitz')
 
+# Buffers are unwrapped a block at a time against a pre-tiled copy of the key so
+# that the XOR can be done in bulk rather than per byte. The block is a whole
+# number of key periods, so every block starts at key offset 0.
+g_kBlock = bytes(g_k * (1 << 13))
 
-def unwrapBuffer(buf, length):
+# For the pure-Python engine: byte i of every key period is XOR'd against the
+# same key byte, so each such "lane" of a block is one bytearray.translate().
+g_kLaneTables = [bytes(bytearray(b ^ c for b in range(256))) for c in g_k]
+
+try:
+    import numpy
+    g_kBlockArray = numpy.frombuffer(g_kBlock, dtype=numpy.uint8)
+except ImportError:  # e.g., the frozen (py2exe) installer
+    numpy = None
+
+
+if hasattr(int, 'from_bytes'):  # Py3
+    def bytesToInt(b):
+        return int.from_bytes(bytes(b), 'big')
+
+    def intToBytes(x, n):
+        return x.to_bytes(n, 'big')
+else:  # Py2
+    def bytesToInt(b):
+        return int(binascii.hexlify(b), 16) if len(b) > 0 else 0
+
+    def intToBytes(x, n):
+        return binascii.unhexlify('%0*x' % (2 * n, x))
+
+
+def unwrapBlockNumPy(buf, start, end):
+    a = numpy.frombuffer(buf, dtype=numpy.uint8, count=end - start, offset=start)
+    a ^= g_kBlockArray[:end - start]
+
+
+def unwrapBlockPure(buf, start, end):
+    n = end - start
+    if n < (1 << 12):  # Too short for per-lane overhead to pay off; XOR as one wide integer
+        buf[start:end] = intToBytes(bytesToInt(buf[start:end]) ^ bytesToInt(g_kBlock[:n]), n)
+        return
     kN = len(g_k)
+    for i in range(min(kN, n)):
+        lane = slice(start + i, end, kN)
+        buf[lane] = buf[lane].translate(g_kLaneTables[i])
+
+
+if numpy is not None:
+    g_unwrapEngine = 'numpy'
+    unwrapBlock = unwrapBlockNumPy
+else:
+    g_unwrapEngine = 'pure'
+    unwrapBlock = unwrapBlockPure
+
+
+def unwrapBuffer(buf, length):
+    blockLen = len(g_kBlock)
+    for start in range(0, length, blockLen):
+        unwrapBlock(buf, start, min(start + blockLen, length))
+
+
+# Files are compiled in chunks through a reusable per-thread buffer. The chunk
+# size is a whole number of unwrapping key periods (and at least 4KB), so every
+# chunk can be unwrapped independently of its offset within the file.
+g_compileChunkLen = len(g_kBlock)
+g_compileBuffers = threading.local()
+
+
+def getCompileBuffer():
+    if not hasattr(g_compileBuffers, 'buf'):
+        g_compileBuffers.buf = bytearray(g_compileChunkLen)
+        g_compileBuffers.view = memoryview(g_compileBuffers.buf)
+    return g_compileBuffers.buf, g_compileBuffers.view
+
+
+def readChunk(f, view):  # Fill view unless EOF is hit, returning the number of bytes read
+    n = 0
+    while n < len(view):
+        r = f.readinto(view[n:])
+        if not r:
+            break
+        n += r
+    return n
+
+
+# Whether the kernel can copy a file for us without a round trip through userspace
+g_kernelCopy = sys.platform.startswith('linux') and (hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'))
+
+
+# Has the kernel copy length bytes from fsrc to fdst. Returns whether it did so.
+def copyFileKernel(fsrc, fdst, length):
+    if hasattr(os, 'copy_file_range'):  # Py3.8+
+        copy = lambda offset: os.copy_file_range(fsrc.fileno(), fdst.fileno(), length - offset, offset, offset)
+    else:  # Py3.3+
+        copy = lambda offset: os.sendfile(fdst.fileno(), fsrc.fileno(), offset, length - offset)
+    offset = 0
+    try:
+        while offset < length:
+            n = copy(offset)
+            if n == 0:
+                break
+            offset += n
+    except OSError:  # e.g., unsupported by the filesystem
+        pass
+    return offset == length
+
+
+# Has the kernel copy src to dst, returning the number of bytes copied, or None
+# if it can't (in which case dst is left for the caller to write).
+def copyFileFast(src, dst):
+    if not g_kernelCopy:
+        return None
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        length = os.fstat(fsrc.fileno()).st_size
+        if copyFileKernel(fsrc, fdst, length):
+            return length
+    return None
+
+
+LINK_HARD = 'hard'
+LINK_REFLINK = 'reflink'
+FICLONE = 0x40049409  # Linux ioctl request to reflink one file to another
+
+
+# Links dst to src according to link mode (LINK_HARD or LINK_REFLINK) rather
+# than copying it. Returns False if that isn't possible here (e.g., src and dst
+# are on different devices, or the filesystem can't reflink), in which case dst
+# is left for the caller to write.
+def linkFile(src, dst, link):
     try:
-        for i in xrange(length):  # Py2
-            buf[i] ^= g_k[i % kN]
-    except NameError:
-        for i in range(length):  # Py3
-            buf[i] ^= g_k[i % kN]
+        if link == LINK_HARD and hasattr(os, 'link'):
+            os.link(src, dst)
+            return True
+        if link == LINK_REFLINK and sys.platform.startswith('linux'):
+            import fcntl
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+    except (IOError, OSError):
+        pass
+    return False
+
+
+class Crc32Hash:  # zlib.crc32 with the hashlib interface
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, b):
+        if sys.version_info[0] < 3 and isinstance(b, memoryview):  # Py2's zlib won't take one
+            b = b.tobytes()
+        self.crc = zlib.crc32(b, self.crc)
 
+    def hexdigest(self):
+        return '{:08x}'.format(self.crc & 0xFFFFFFFF)
+
+
+# Checksum algorithms a manifest can name, for those that are available here.
+# Old manifests don't name one and are MD5.
+g_hashes = {'md5': hashlib.md5, 'crc32': Crc32Hash}
+
+if hasattr(hashlib, 'blake2b'):  # Py3.6+
+    g_hashes['blake2b'] = lambda: hashlib.blake2b(digest_size=16)
+else:
+    try:
+        import pyblake2
+        g_hashes['blake2b'] = lambda: pyblake2.blake2b(digest_size=16)
+    except ImportError:
+        pass
 
-def compileTargetFile(src, dst, wrap, manifest):
+try:
+    import xxhash
+    g_hashes['xxh64'] = xxhash.xxh64
+except ImportError:
+    pass
+
+
+# Checksums the file at path after (un)wrapping it per wrap. Since wrapping is
+# its own inverse, this also gives the checksum of a compiled file's source.
+# The work done is added to stats (see newCompileStats), if given.
+def hashFile(path, wrap=WRAP_NONE, hashName='md5', stats=None):
+    if stats is None:
+        stats = newCompileStats()
+    buf, view = getCompileBuffer()
+    cksum = g_hashes[hashName]()
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            t = g_clock()
+            n = readChunk(f, view)
+            t = lapTime(stats, STAT_READ, t)
+            if n == 0:
+                break
+            if wrap == WRAP_TOTAL:
+                unwrapBuffer(buf, n)
+            elif wrap == WRAP_QUICK and offset == 0:
+                unwrapBuffer(buf, min(1 << 12, n))
+            t = lapTime(stats, STAT_UNWRAP, t)
+            cksum.update(view[:n])
+            lapTime(stats, STAT_HASH, t)
+            offset += n
+    stats[STAT_BYTES] += offset
+    return cksum.hexdigest()
+
+
+# Does the file I/O and unwrapping for a single file, returning its checksum
+# (per hashName, if set). It doesn't touch any installer state, so it can run in
+# a worker. Files that needn't be unwrapped are linked instead of copied if link
+# is set, and otherwise copied by the kernel where possible, in which case the
+# checksum is then taken from the source's now-cached pages. The work done is
+# added to stats, if given; the time taken by a link or a kernel copy counts as
+# writing.
+def compileFile(src, dst, wrap, hashName, link=None, stats=None):
+    if stats is None:
+        stats = newCompileStats()
+    if wrap == WRAP_NONE and link:
+        t = g_clock()
+        linked = linkFile(src, dst, link)
+        lapTime(stats, STAT_WRITE, t)
+        if linked:
+            if hashName:
+                return hashFile(src, WRAP_NONE, hashName, stats)
+            stats[STAT_BYTES] += os.path.getsize(src)
+            return None
+    if wrap == WRAP_NONE:
+        t = g_clock()
+        length = copyFileFast(src, dst)
+        lapTime(stats, STAT_WRITE, t)
+        if length is not None:
+            if hashName:
+                return hashFile(src, WRAP_NONE, hashName, stats)
+            stats[STAT_BYTES] += length
+            return None
+    buf, view = getCompileBuffer()
+    cksum = g_hashes[hashName]() if hashName else None
+    offset = 0
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            t = g_clock()
+            n = readChunk(fsrc, view)
+            t = lapTime(stats, STAT_READ, t)
+            if n == 0:
+                break
+            if cksum:
+                cksum.update(view[:n])
+                t = lapTime(stats, STAT_HASH, t)
+            if wrap == WRAP_TOTAL:
+                unwrapBuffer(buf, n)
+            elif wrap == WRAP_QUICK and offset == 0:
+                unwrapBuffer(buf, min(1 << 12, n))
+            t = lapTime(stats, STAT_UNWRAP, t)
+            fdst.write(view[:n])
+            lapTime(stats, STAT_WRITE, t)
+            offset += n
+    stats[STAT_BYTES] += offset
+    return cksum.hexdigest() if cksum else None
+
+
+# Pool entry point; each task is (src, dst, wrap, hashName, link), and each
+# result is (dst, checksum, compile stats).
+def compileTasks(tasks):
+    results = []
+    for t in tasks:
+        stats = newCompileStats()
+        results.append((t[1], compileFile(*t, stats=stats), stats))
+    return results
+
+
+def chunkList(l, n):
+    return [l[i:i + n] for i in range(0, len(l), n)]
+
+
+g_modified = False  # Whether any installed file didn't match the release manifest
+
+
+# Called once for every compiled (or skipped, in incremental mode) target file
+# with the checksum of its source.
+def recordTargetFile(dst, cksum, manifest, cksums):
     global g_modified
-    length = os.path.getsize(src)
-    buf = bytearray(length)
-    with open(src, 'rb') as fsrc:
-        fsrc.readinto(buf)
-    if manifest:
-        hash_md5 = hashlib.md5()
-        hash_md5.update(buf)
-        cksum = hash_md5.hexdigest()
-    if wrap != WRAP_NONE:
-        if wrap == WRAP_QUICK:
-            length = min(1 << 12, length)
-        unwrapBuffer(buf, length)
-    with open(dst, 'wb') as fdst:
-        fdst.write(buf)
+    src = g_targetSrc[dst].srcPath
+    cksums[dst] = cksum
     if manifest and manifest.get(src, None) != cksum:
         g_dbg.trace("checksumMismatch('{}')".format(src))
         g_modified = True
 
 
-# startFolder is the reference point for the relative paths in the map file
-def compileTarget(mapFilename, startFolder, manifest):
+def printProgress(n, x):
+    if n > 0 and x > 0 and (x < 1 or n % x < (n - 1) % x):
+        print('{}%'.format(int(n / x) * 5))
+        sys.stdout.flush()
+
+
+# Py2's pool result iterators can't be interrupted by Ctrl+C while waiting
+# without a timeout, so always wait with one.
+def iterPoolResults(it):
+    while True:
+        try:
+            yield it.next(0xFFFF)
+        except StopIteration:
+            return
+
+
+# startFolder is the reference point for the relative paths in the map file.
+# Target files in skip (target path => source checksum) are already up-to-date
+# and aren't rewritten. link is the optional link mode for unwrapped files (see
+# linkFile). Returns the source checksums of all target files. Files are written
+# to their stagedPath(), in case the target folder is staged.
+def compileTarget(mapFilename, startFolder, manifest, jobs=1, skip=None, link=None):
     print(localise('COMPILING'))
     sys.stdout.flush()
+    if skip is None:
+        skip = {}
+    if jobs > 1:
+        return compileTargetParallel(mapFilename, startFolder, manifest, jobs, skip, link)
+    hashName = manifest.hashName if manifest else None
+    cksums = {}
     x = len(g_targetSrc) / 20.0
     with open(mapFilename, 'w') as mapFile:
         for n, dstPath in enumerate(sorted(g_targetSrc)):
-            if n > 0 and x > 0 and (x < 1 or n % x < (n - 1) % x):
-                print('{}%'.format(int(n / x) * 5))
-                sys.stdout.flush()
+            printProgress(n, x)
             src = g_targetSrc[dstPath]
             mapFile.write('{} <= [{}]\n'.format(os.path.relpath(dstPath, startFolder), src.folder))
+            outPath = stagedPath(dstPath)
             if src.isDir:
-                mkTree(dstPath)
+                if not os.path.isdir(outPath):
+                    mkTree(outPath)
+            elif dstPath in skip:
+                g_prof.addSkip(src.folder)
+                recordTargetFile(dstPath, skip[dstPath], manifest, cksums)
+            else:
+                stats = newCompileStats()
+                cksum = compileFile(src.srcPath, outPath, src.wrap, hashName, link, stats)
+                g_prof.addCompile(src.folder, stats)
+                recordTargetFile(dstPath, cksum, manifest, cksums)
+    return cksums
+
+
+# Same output as the serial compileTarget, but with the map file written and all
+# directories created up front, after which the files are compiled by a pool of
+# workers: threads for plain copies and WRAP_QUICK (I/O-bound; hashlib releases
+# the GIL), processes for WRAP_TOTAL (CPU-bound unwrapping).
+def compileTargetParallel(mapFilename, startFolder, manifest, jobs, skip, link):
+    g_dbg.push('compileTargetParallel(jobs={})'.format(jobs))
+    hashName = manifest.hashName if manifest else None
+    cksums = {}
+    total = len(g_targetSrc)
+    x = total / 20.0
+    n = 0
+    ioTasks = []
+    cpuTasks = []
+    dstPaths = {}  # Path written => target path
+    with open(mapFilename, 'w') as mapFile:
+        for dstPath in sorted(g_targetSrc):
+            src = g_targetSrc[dstPath]
+            mapFile.write('{} <= [{}]\n'.format(os.path.relpath(dstPath, startFolder), src.folder))
+            outPath = stagedPath(dstPath)
+            dstPaths[outPath] = dstPath
+            if src.isDir or dstPath in skip:
+                printProgress(n, x)
+                if dstPath in skip:
+                    g_prof.addSkip(src.folder)
+                    recordTargetFile(dstPath, skip[dstPath], manifest, cksums)
+                elif not os.path.isdir(outPath):
+                    mkTree(outPath)
+                n += 1
+            elif src.wrap == WRAP_TOTAL:
+                cpuTasks.append((src.srcPath, outPath, src.wrap, hashName, link))
             else:
-                compileTargetFile(src.srcPath, dstPath, src.wrap, manifest)
+                ioTasks.append((src.srcPath, outPath, src.wrap, hashName, link))
+    g_dbg.trace('numTasks(io={}, cpu={})'.format(len(ioTasks), len(cpuTasks)))
+    for outPath, cksum, stats in runPoolTasks(compileTasks, ioTasks, cpuTasks, jobs):
+        printProgress(n, x)
+        g_prof.addCompile(g_targetSrc[dstPaths[outPath]].folder, stats)
+        recordTargetFile(dstPaths[outPath], cksum, manifest, cksums)
+        n += 1
+    g_dbg.pop()
+    return cksums
+
+
+# Runs func (a pool entry point taking a list of tasks and returning a list of
+# results) over ioTasks in a thread pool and cpuTasks in a process pool,
+# yielding each task's result in order of completion.
+def runPoolTasks(func, ioTasks, cpuTasks, jobs):
+    pools = []
+    try:
+        results = []
+        if cpuTasks:
+            pools.append(multiprocessing.Pool(jobs))
+            results.append(pools[-1].imap_unordered(func, chunkList(cpuTasks, 4)))
+        if ioTasks:
+            pools.append(ThreadPool(jobs))
+            results.append(pools[-1].imap_unordered(func, chunkList(ioTasks, 16)))
+        for it in results:
+            for chunk in iterPoolResults(it):
+                for r in chunk:
+                    yield r
+        for pool in pools:
+            pool.close()
+            pool.join()
+    finally:
+        for pool in pools:
+            pool.terminate()
+
+
+g_installStateFilename = 'install_state.txt'
+g_installStateVersion = 2
+
+
+# Stats the source of every target file, mapping its target path to its
+# (size, mtime) as they're recorded in the install state file.
+def statTargetSources():
+    stats = {}
+    for dstPath, src in g_targetSrc.items():
+        if not src.isDir:
+            st = os.stat(src.srcPath)
+            stats[dstPath] = (st.st_size, int(st.st_mtime * 1000))
+    return stats
+
+
+# The install state file records, for every target file of the last completed
+# install, the source it was compiled from (winning module, path, wrap mode,
+# size, mtime, and checksum). Returns None if there's no usable state. Checksums
+# taken with other than hashName are dropped.
+def loadInstallState(targetFolder, hashName):
+    g_dbg.push('loadInstallState("{}")'.format(targetFolder))
+    path = os.path.join(targetFolder, g_installStateFilename)
+    state = {}
+    try:
+        with open(path) as f:
+            if f.readline().rstrip('\r\n') != 'version: {}'.format(g_installStateVersion):
+                g_dbg.pop('installStateVersionMismatch')
+                return None
+            m = re.match(r'^hash: (.*)$', f.readline().rstrip('\r\n'))
+            if not m:
+                raise ValueError('missing hash line')
+            sameHash = m.group(1) == (hashName or '-')
+            for line in f:
+                dst, folder, srcPath, wrap, size, mtime, cksum = line.rstrip('\r\n').split('\t')
+                if cksum == '-' or not sameHash:
+                    cksum = None
+                state[dst] = (folder, srcPath, int(wrap), int(size), int(mtime), cksum)
+    except (IOError, OSError, ValueError) as e:
+        g_dbg.pop('failureLoadingInstallState("{}")'.format(e))
+        return None
+    g_dbg.pop('installStateSize({})'.format(len(state)))
+    return state
+
+
+def saveInstallState(targetFolder, srcStats, cksums, hashName):
+    path = os.path.join(targetFolder, g_installStateFilename)
+    g_dbg.trace('saveInstallState("{}")'.format(path))
+    with open(path, 'w') as f:
+        f.write('version: {}\n'.format(g_installStateVersion))
+        f.write('hash: {}\n'.format(hashName or '-'))
+        for dst in sorted(cksums):
+            src = g_targetSrc[dst]
+            size, mtime = srcStats[dst]
+            cksum = cksums[dst] if cksums[dst] is not None else '-'
+            f.write('\t'.join([dst, src.folder, src.srcPath, str(src.wrap), str(size), str(mtime), cksum]) + '\n')
+
+
+# Brings a preexisting targetFolder in line with g_targetSrc for an incremental
+# install: anything that isn't in g_targetSrc is deleted, and the target files
+# whose source (module, path, wrap mode, size & mtime) is the same as recorded
+# in prevState are returned (target path => source checksum) to be skipped.
+# Other target files are deleted too, as they may be links to their previous
+# source, which must not be written through.
+def pruneTarget(targetFolder, prevState, srcStats, manifest):
+    g_dbg.push('pruneTarget("{}")'.format(targetFolder))
+    nRemoved = 0
+    for root, dirs, files in os.walk(targetFolder):
+        keptDirs = []
+        for d in dirs:
+            p = os.path.join(root, d)
+            if p in g_targetSrc and g_targetSrc[p].isDir:
+                keptDirs.append(d)
+            else:
+                rmTree(p)
+                nRemoved += 1
+        dirs[:] = keptDirs
+        for f in files:
+            p = os.path.join(root, f)
+            if p not in g_targetSrc or g_targetSrc[p].isDir:
+                rmFile(p)
+                nRemoved += 1
+    unchanged = {}
+    for dst, (size, mtime) in srcStats.items():
+        prev = prevState.get(dst)
+        src = g_targetSrc[dst]
+        if prev is None or prev[:5] != (src.folder, src.srcPath, src.wrap, size, mtime):
+            continue
+        if manifest and prev[5] is None:  # Need a checksum we didn't take last time
+            continue
+        if not os.path.isfile(dst) or os.path.getsize(dst) != size:
+            continue
+        unchanged[dst] = prev[5]
+    for dst in srcStats:
+        if dst not in unchanged and os.path.lexists(dst):
+            rmFile(dst)
+            nRemoved += 1
+    g_dbg.pop('numRemoved({}), numUnchanged({})'.format(nRemoved, len(unchanged)))
+    return unchanged
+
+
+# Returns the value of a command-line option given as either "--opt=value" or
+# "--opt value", or default if the option isn't present.
+def getOptionValue(option, default=None):
+    args = sys.argv[1:]
+    for i, a in enumerate(args):
+        if a.startswith(option + '='):
+            return a[len(option) + 1:]
+        if a == option and i + 1 < len(args):
+            return args[i + 1]
+    return default
+
+
+def getCompileJobs():
+    try:
+        default = multiprocessing.cpu_count()
+    except NotImplementedError:
+        default = 1
+    try:
+        jobs = int(getOptionValue('--jobs', default))
+    except ValueError:
+        raise InstallerArgumentError('--jobs')
+    if jobs < 1:
+        raise InstallerArgumentError('--jobs')
+    return jobs
+
+
+# --debug-sample=N keeps only every Nth line of the debug log (see DebugTrace),
+# and implies --debug.
+def getDebugSample():
+    try:
+        sample = int(getOptionValue('--debug-sample', 1))
+    except ValueError:
+        raise InstallerArgumentError('--debug-sample')
+    if sample < 1:
+        raise InstallerArgumentError('--debug-sample')
+    return sample
+
+
+def getLinkMode():
+    link = getOptionValue('--link')
+    if link not in (None, LINK_HARD, LINK_REFLINK):
+        raise InstallerArgumentError('--link')
+    return link
 
 
 def detectPlatform():
@@ -359,11 +1398,17 @@ def detectPlatform():
     raise InstallerPlatformError()
 
 
+g_platform = None  # Set by main()
+
+
+# The caches are removed in the background (see Reaper), so this returns at once
 def cleanUserDir(userDir):
     g_dbg.push('cleanUserDir("{}")'.format(userDir))
+    reapTombstones(userDir)
     for d in [os.path.join(userDir, e) for e in ['gfx', 'map']]:
         if os.path.isdir(d):
-            rmTree(d)
+            g_reaper.remove(d)
+    g_dbg.pop()
 
 
 def resetCaches():
@@ -435,50 +1480,396 @@ def printVersionEnvInfo():
     return
 
 
+# Release manifest: module file checksums, keyed by path under modules/. Paths
+# are kept sorted ('/'-separated and relative to modules/) alongside a single
+# buffer of raw digests. Lookups bisect the paths, so nothing is built per
+# entry upon loading, and whole module folders can be sliced out by prefix.
+class Manifest:
+    def __init__(self, paths, digests, digestLen, time=None, hashName='md5'):
+        self.paths = paths
+        self.digests = digests
+        self.digestLen = digestLen
+        self.time = time
+        self.hashName = hashName
+
+    @staticmethod
+    def fromPairs(pairs, time=None, hashName='md5'):  # (path, hex digest) pairs, in any order
+        pairs.sort()
+        digestLen = len(pairs[0][1]) // 2 if pairs else 16
+        digests = binascii.unhexlify(''.join(p[1] for p in pairs))
+        return Manifest([p[0] for p in pairs], digests, digestLen, time, hashName)
+
+    def digest(self, i):
+        n = self.digestLen
+        return str(binascii.hexlify(self.digests[i * n:(i + 1) * n]).decode('ascii'))
+
+    def lookup(self, path):  # Native path under modules/ => hex digest, or None
+        if not path.startswith(g_manifestPathPrefix):
+            return None
+        path = path[len(g_manifestPathPrefix):]
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        i = bisect.bisect_left(self.paths, path)
+        if i == len(self.paths) or self.paths[i] != path:
+            return None
+        return self.digest(i)
+
+    def range(self, folder):  # Index range of the paths under a module folder
+        start = folder + '/'
+        end = folder + chr(ord('/') + 1)  # Just past every path starting with folder + '/'
+        return bisect.bisect_left(self.paths, start), bisect.bisect_left(self.paths, end)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for p in self.paths:
+            yield os.path.join('modules', os.path.normpath(p))
+
+    def __contains__(self, path):
+        return self.lookup(path) is not None
+
+    def __getitem__(self, path):
+        cksum = self.lookup(path)
+        if cksum is None:
+            raise KeyError(path)
+        return cksum
+
+    def get(self, path, default=None):
+        cksum = self.lookup(path)
+        return default if cksum is None else cksum
+
+    # Returns a new manifest in which the entries under each of folders are
+    # replaced wholesale by other's and other's remaining entries are overlaid.
+    def merge(self, other, folders):
+        if other.hashName != self.hashName or other.digestLen != self.digestLen:
+            raise ValueError('cannot merge manifests with different checksum algorithms')
+        n = self.digestLen
+        paths = []
+        digests = []
+        taken = []
+        pos = 0
+        for folder in sorted(folders, key=lambda f: f + '/'):  # i.e., by range start
+            i, j = self.range(folder)
+            k, l = other.range(folder)
+            paths += self.paths[pos:i]
+            digests.append(self.digests[pos * n:i * n])
+            paths += other.paths[k:l]
+            digests.append(other.digests[k * n:l * n])
+            taken.append((k, l))
+            pos = max(pos, j)
+        paths += self.paths[pos:]
+        digests.append(self.digests[pos * n:])
+        merged = Manifest(paths, b''.join(digests), n, self.time, self.hashName)
+        # Anything else in other (there's seldom any) is overlaid the slow way
+        rest = []
+        pos = 0
+        for k, l in sorted(taken) + [(len(other), len(other))]:
+            rest += [(other.paths[x], other.digest(x)) for x in range(pos, k)]
+            pos = max(pos, l)
+        if rest:
+            pairs = dict((merged.paths[x], merged.digest(x)) for x in range(len(merged)))
+            pairs.update(rest)
+            merged = Manifest.fromPairs(list(pairs.items()), self.time, self.hashName)
+        return merged
+
+
+g_manifestPathPrefix = 'modules' + os.sep
+g_manifestVersion = 2  # Version 1 manifests have no header fields past the time and are MD5
+g_manifestCacheMagic = b'HIPMNFST'
+g_manifestCacheVersion = 2
+g_manifestCacheHeader = '<8sHHIqq'  # magic, version, digestLen, count, source size, source mtime (usec)
+
+
+def getManifestCachePath(path):
+    return os.path.splitext(path)[0] + '.bin'
+
+
+def getManifestStamp(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime * 1000000)
+
+
+# Loads the binary cache of a text manifest, or returns None if it's missing
+# or wasn't built from the text manifest as it is now.
+def loadManifestCache(path, stamp):
+    cachePath = getManifestCachePath(path)
+    if not os.path.exists(cachePath):
+        return None
+    try:
+        with open(cachePath, 'rb') as f:
+            data = f.read()
+        headerLen = struct.calcsize(g_manifestCacheHeader)
+        magic, version, digestLen, count, size, mtime = struct.unpack_from(g_manifestCacheHeader, data)
+        if magic != g_manifestCacheMagic or version != g_manifestCacheVersion or (size, mtime) != stamp:
+            return None
+        metaLen, = struct.unpack_from('<H', data, headerLen)
+        pos = headerLen + 2
+        t, hashName = str(data[pos:pos + metaLen].decode('ascii')).split('\n')
+        pos += metaLen
+        digests = data[pos:pos + count * digestLen]
+        pos += count * digestLen
+        paths = data[pos:]
+        if sys.version_info[0] >= 3:
+            paths = paths.decode('utf-8')
+        paths = paths.split('\n') if count else []
+        if len(paths) != count or len(digests) != count * digestLen:
+            return None
+    except (IOError, struct.error, UnicodeError, ValueError) as e:
+        g_dbg.trace('failureLoadingManifestCache("{}")'.format(e))
+        return None
+    return Manifest(paths, digests, digestLen, t or None, hashName)
+
+
+def saveManifestCache(path, stamp, manifest):
+    cachePath = getManifestCachePath(path)
+    tmpPath = cachePath + '.tmp'
+    meta = '{}\n{}'.format(manifest.time or '', manifest.hashName).encode('ascii')
+    paths = '\n'.join(manifest.paths)
+    if not isinstance(paths, bytes):
+        paths = paths.encode('utf-8')
+    try:
+        with open(tmpPath, 'wb') as f:
+            f.write(struct.pack(g_manifestCacheHeader, g_manifestCacheMagic, g_manifestCacheVersion,
+                                manifest.digestLen, len(manifest), stamp[0], stamp[1]))
+            f.write(struct.pack('<H', len(meta)))
+            f.write(meta)
+            f.write(manifest.digests)
+            f.write(paths)
+        if os.path.exists(cachePath):
+            os.unlink(cachePath)  # Py2 can't rename over an existing file on Windows
+        os.rename(tmpPath, cachePath)
+    except (IOError, OSError) as e:  # Read-only package folder, etc.; we'll just parse again next time
+        g_dbg.trace('failureSavingManifestCache("{}")'.format(e))
+
+
 def loadManifestFile(path):
     g_dbg.push('loadManifestFile"{}")'.format(path))
-    manifest = {}
-    t = None
     if not os.path.exists(path):
         g_dbg.pop('manifestPathNotFound("{}")'.format(path))
-        return (None, t)
+        return None
     try:
-        with open(path) as f:
-            timeline = f.readline().rstrip('\r\n')
-            m = re.match(r'^time: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$', timeline)
-            if m:
-                t = m.group(1)
-            for line in f:
-                relpath, cksum = line.split(' // ')
-                path = os.path.join('modules', os.path.normpath(relpath))
-                manifest[path] = cksum.strip()
-    except IOError as e:
+        stamp = getManifestStamp(path)
+        manifest = loadManifestCache(path, stamp)
+        if manifest is not None:
+            g_dbg.pop('manifestSize({}, cached)'.format(len(manifest)))
+            return manifest
+        with open(path, 'rb') as f:
+            data = f.read()
+        if sys.version_info[0] >= 3:
+            data = data.decode('utf-8')
+        if '\\' in data:  # Written on Windows
+            data = data.replace('\\', '/')
+        lines = data.replace('\r', '').split('\n')
+        # The header is 'time: <time>', then in version 2+ ' // key: value' fields
+        header = lines[0].split(' // ')
+        m = re.match(r'^time: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$', header[0])
+        t = str(m.group(1)) if m else None
+        headerFields = dict(str(f).split(': ', 1) for f in header[1:] if ': ' in f)
+        if int(headerFields.get('version', 1)) > g_manifestVersion:
+            raise ValueError('unsupported manifest version {}'.format(headerFields['version']))
+        hashName = headerFields.get('hash', 'md5')
+        lines = [line for line in lines[1:] if line]
+        lines.sort()  # By path, as ' // ' sorts before any path's continuation
+        fields = ' // '.join(lines).split(' // ')
+        if len(fields) != 2 * len(lines):
+            raise ValueError('malformed manifest line')
+        digestLen = len(fields[1]) // 2 if lines else 16
+        manifest = Manifest(fields[0::2], binascii.unhexlify(''.join(fields[1::2])), digestLen, t, hashName)
+        if len(manifest.digests) != digestLen * len(manifest):
+            raise ValueError('manifest digests are not all the same length')
+    except (IOError, OSError, ValueError, TypeError, UnicodeError) as e:
         g_dbg.pop('failureLoadingManifest("{}")'.format(e))
-        return (None, t)
+        return None
+    saveManifestCache(path, stamp, manifest)
     g_dbg.pop('manifestSize({})'.format(len(manifest)))
-    return (manifest, t)
+    return manifest
+
 
+g_emfRepoFolders = ('EMF', 'EMF+MiniSWMH', 'EMF+SWMH', 'EMF+Vanilla')
 
+
+# Returns the merged manifest, the release manifest's time, and whether an EMF
+# beta manifest newer than the release was merged into it. The manifest is None
+# if checksums can't be checked, e.g. for want of its checksum algorithm here.
 def loadManifest():
     g_dbg.push('loadManifest')
     stdManifestPath = os.path.normpath('modules/release_manifest.txt')
     emfManifestPath = os.path.normpath('modules/emf_beta_manifest.txt')
-    stdManifest, stdTime = loadManifestFile(stdManifestPath)
-    emfManifest, emfTime = loadManifestFile(emfManifestPath)
-    if emfManifest and emfTime and stdTime and emfTime > stdTime:
-        # For every path (key) in stdManifest which is not in emfManifest and is under one of the EMF repository module
-        # folders (i.e., EMF, EMF+MiniSWMH, EMF+SWMH, and EMF+Vanilla), delete the path from stdManifest.
-        toDelete = []
-        for s in stdManifest:
-            if s not in emfManifest and s[:s.find('/')] in ('EMF', 'EMF+MiniSWMH', 'EMF+SWMH', 'EMF+Vanilla'):
-                toDelete.append(s)
-        for d in toDelete:
-            del stdManifest[d]
-        # Now, let entries that ARE in emfManifest override/add to stdManifest:
-        for e in emfManifest:
-            stdManifest[e] = emfManifest[e]
-    return stdManifest
-    g_dbg.pop('finalManifestSize({})'.format(len(stdManifest)))
+    stdManifest = loadManifestFile(stdManifestPath)
+    stdTime = stdManifest.time if stdManifest is not None else None
+    emfManifest = loadManifestFile(emfManifestPath)
+    emfApplied = False
+    if emfManifest and emfManifest.time and stdTime and emfManifest.time > stdTime:
+        emfApplied = True
+        # The EMF beta replaces the EMF repository's module folders (i.e., EMF,
+        # EMF+MiniSWMH, EMF+SWMH, and EMF+Vanilla) wholesale, and any other
+        # entries in it override/add to the release's.
+        if emfManifest.hashName == stdManifest.hashName:
+            stdManifest = stdManifest.merge(emfManifest, g_emfRepoFolders)
+        else:
+            g_dbg.trace('emfManifestHashMismatch("{}", "{}")'.format(emfManifest.hashName, stdManifest.hashName))
+            stdManifest = None
+    if stdManifest and stdManifest.hashName not in g_hashes:
+        g_dbg.trace('manifestHashUnavailable("{}")'.format(stdManifest.hashName))
+        stdManifest = None
+    g_dbg.pop('finalManifestSize({})'.format(len(stdManifest) if stdManifest else 0))
+    return (stdManifest, stdTime, emfApplied)
+
+
+# Index of every directory and file under modules/, written by shrinkwrap.py
+# at release time so that pushFolder needn't walk module folders.
+class ModuleIndex:
+    def __init__(self, dirs, files, staleFolders):
+        self.dirs = sorted(dirs)  # '/'-separated paths relative to modules/
+        self.files = sorted(files)  # (path, isQuickUnwrapped) pairs, likewise
+        self.filePaths = [f[0] for f in self.files]
+        self.staleFolders = staleFolders
+
+    # Returns the (dirs, files) under the module folder, relative to it and with
+    # native path separators, or None if the folder isn't indexed or is stale.
+    def folder(self, folder):
+        folder = folder.replace(os.sep, '/')
+        if folder.split('/')[0] in self.staleFolders:
+            return None
+        start = folder + '/'
+        end = folder + chr(ord('/') + 1)  # Just past every path starting with folder + '/'
+        i, j = bisect.bisect_left(self.dirs, start), bisect.bisect_left(self.dirs, end)
+        k, l = bisect.bisect_left(self.filePaths, start), bisect.bisect_left(self.filePaths, end)
+        if i == j and k == l:
+            return None
+        n = len(start)
+        return ([os.path.normpath(d[n:]) for d in self.dirs[i:j]],
+                [(os.path.normpath(p[n:]), quick) for p, quick in self.files[k:l]])
+
+
+g_moduleIndex = None
+
+
+# The module index is only trusted if it's from the same release as the
+# manifest. A module folder's part of it is stale if an mtime of one of its
+# directories isn't as recorded (i.e., files were added or removed since the
+# release), which costs a stat per directory rather than a walk. An EMF beta
+# replaces the EMF repository's module folders, so those are stale if one was
+# applied.
+def loadModuleIndex(manifestTime, emfApplied):
+    path = os.path.normpath('modules/module_index.txt')
+    g_dbg.push('loadModuleIndex("{}")'.format(path))
+    if not os.path.exists(path):
+        g_dbg.pop('moduleIndexNotFound')
+        return None
+    dirs = []
+    dirMTimes = []
+    files = []
+    try:
+        with open(path) as f:
+            m = re.match(r'^time: (.+)$', f.readline().rstrip('\r\n'))
+            if not m or manifestTime is None or m.group(1) != manifestTime:
+                g_dbg.pop('moduleIndexStale')
+                return None
+            for line in f:
+                relpath, field = line.rstrip('\r\n').split(' // ')
+                if relpath.endswith('/'):
+                    dirs.append(relpath[:-1])
+                    dirMTimes.append(int(field))
+                else:
+                    files.append((relpath, field == 'q'))
+    except (IOError, ValueError) as e:
+        g_dbg.pop('failureLoadingModuleIndex("{}")'.format(e))
+        return None
+    staleFolders = set(g_emfRepoFolders) if emfApplied else set()
+    for d, mtime in zip(dirs, dirMTimes):
+        folder = d.split('/')[0]
+        if folder in staleFolders:
+            continue
+        try:
+            changed = int(os.stat(os.path.join('modules', os.path.normpath(d))).st_mtime) != mtime
+        except OSError:
+            changed = True
+        if changed:
+            g_dbg.trace('moduleFolderChanged("{}", "{}")'.format(folder, d))
+            staleFolders.add(folder)
+    g_dbg.pop('moduleIndexSize(dirs={}, files={}, staleFolders={})'.format(len(dirs), len(files), len(staleFolders)))
+    return ModuleIndex(dirs, files, staleFolders)
+
+
+g_blobStoreFolder = 'blobs'
+g_blobIndexFilename = 'blob_index.txt'
+
+
+# Content-addressed store of the module files that shrinkwrap.py --dedup found
+# duplicated across module folders: each distinct file is kept once, under
+# modules/blobs/ and named by its checksum, in place of all of its copies. The
+# blob index maps the path of each copy under modules/ to its blob.
+class BlobStore:
+    def __init__(self, blobs):  # ('/'-separated path relative to modules/, blob name) pairs
+        self.blobs = {}  # Native path => native path of its blob
+        self.dirFiles = {}  # Native directory path => names of its files that are in the store
+        for relPath, blob in blobs:
+            path = os.path.join('modules', os.path.normpath(relPath))
+            self.blobs[path] = os.path.join('modules', g_blobStoreFolder, blob)
+            head, tail = os.path.split(path)
+            self.dirFiles.setdefault(head, []).append(tail)
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def resolve(self, path):  # The path of the file which holds the contents of the module file at path
+        return self.blobs.get(path, path)
+
+    def listDir(self, path):  # Names of the files in the directory that are in the store
+        return self.dirFiles.get(path, [])
+
+
+g_blobStore = BlobStore([])
+
+
+# Unlike the module index, the blob index isn't an optional shortcut: the files
+# in it aren't in their module folders at all. So it's used whatever its time,
+# except for the EMF repository's module folders if an EMF beta replaced them.
+# If it can't be read, or a blob it names is missing, some module files would
+# be missing from the install, so the package is reported as damaged.
+def loadBlobStore(emfApplied):
+    path = os.path.join('modules', g_blobIndexFilename)
+    g_dbg.push('loadBlobStore("{}")'.format(path))
+    if not os.path.exists(path):
+        g_dbg.pop('blobIndexNotFound')
+        return BlobStore([])
+    staleFolders = g_emfRepoFolders if emfApplied else ()
+    blobs = []
+    try:
+        with open(path) as f:
+            if not f.readline().startswith('time: '):
+                raise ValueError('missing time line')
+            for line in f:
+                relPath, blob = line.rstrip('\r\n').split(' // ')
+                if relPath.split('/')[0] not in staleFolders:
+                    blobs.append((relPath, blob))
+        for blob in set(b for p, b in blobs):
+            if not os.path.isfile(os.path.join('modules', g_blobStoreFolder, blob)):
+                raise ValueError('missing blob {}'.format(blob))
+    except (IOError, OSError, ValueError) as e:
+        g_dbg.pop('failureLoadingBlobStore("{}")'.format(e))
+        raise InstallerPackageDamagedError(path, e)
+    g_dbg.pop('blobStoreSize({})'.format(len(blobs)))
+    return BlobStore(blobs)
+
+
+g_versions = {}
+
+# These are the modules/ directories from which to grab each mod's version.txt:
+g_modVersionDirs = {'pkg': '',   # Installer package version
+                    'SWMH':      'SWMH',
+                    'CPR':       'CPRplus',
+                    'EMF':       'EMF',
+                    'SED':       'SED2',
+                    'ARKOC':     'ARKOpack_Armoiries',
+                    'ARKOI':     'ARKOpack_Interface',
+                    'ArumbaKS':  'ArumbaKS',
+                    'uSWMH':     'MiniSWMH',
+                    'LTM':       'LTM+SWMH',
+                    'Converter': 'Converter'
+}
 
 
 def getPkgVersions(modDirs):
@@ -497,6 +1888,7 @@ def getPkgVersions(modDirs):
 
 g_defaultFolder = 'Historical_Immersion_Project'
 g_spacedDefaultFolder = g_defaultFolder.replace('_', ' ')
+g_steamMode = False
 
 
 def getInstallOptions(batchMode=False):
@@ -751,6 +2143,128 @@ def printCPRReqDLCNames():
     print()
 
 
+# Files which the installer itself writes into the target folder after compiling
+g_generatedFiles = ['version.txt', 'file2mod_map.txt', g_installStateFilename,
+                    os.path.join('history', 'titles', 'e_null.txt')]
+
+
+# Resolves the source file in modules/ of an entry in a target folder's
+# file2mod_map.txt (relPath <= [folder]), or None if it can't be found.
+def resolveMapEntry(relPath, folder, manifest):
+    rel = splitPath(relPath)
+    if rel and rel[0] == '..':  # Compiled into a sibling target folder (e.g., the Converter's)
+        rel = rel[2:]
+    f = splitPath(folder)
+    srcFolder = os.path.join('modules', *f)
+    # Module folders can be pushed into a subfolder of the same name (e.g.,
+    # SWMH/gfx/flags into gfx/flags), so also try without such a prefix.
+    for k in range(0, min(len(f), len(rel)) + 1):
+        if f[len(f) - k:] != rel[:k]:
+            continue
+        src = os.path.join(srcFolder, *rel[k:]) if rel[k:] else srcFolder
+        if src in manifest or os.path.exists(src):
+            return src
+    return None
+
+
+def getWrapType(folder, src):
+    srcFolder = os.path.join('modules', os.path.normpath(folder))
+    for p in g_moduleWrapPaths.get(folder, []):
+        wrapFolder = os.path.join(srcFolder, os.path.normpath(p))
+        if src.startswith(wrapFolder + os.sep) and not src.endswith('version.txt'):
+            return WRAP_QUICK if isFileQuickUnwrapped(src) else WRAP_TOTAL
+    return WRAP_NONE
+
+
+def verifyTasks(tasks):  # Pool entry point; each task is (src, dst, wrap, hashName, cksum)
+    return [(t, hashFile(t[1], t[2], t[3]) == t[4]) for t in tasks]
+
+
+# Checks an existing installation in targetFolder against the release: every
+# file listed in its file2mod_map.txt must be there and, once rewrapped, match
+# the manifest checksum of the module file that won its path. If repair is set,
+# bad files are compiled anew. Returns the process exit code.
+def verifyInstall(targetFolder, manifest, jobs, repair):
+    g_dbg.push('verifyInstall("{}", repair={})'.format(targetFolder, repair))
+    mapFilename = os.path.join(targetFolder, 'file2mod_map.txt')
+    if not manifest or not os.path.isfile(mapFilename):
+        print('Cannot verify: {}.'.format('no usable release manifest' if not manifest else mapFilename + ' not found'))
+        g_dbg.pop()
+        return 3
+    print("> Verifying '{}' ...".format(targetFolder))
+    sys.stdout.flush()
+    startTime = time.time()
+    generated = set(os.path.join(targetFolder, g) for g in g_generatedFiles)
+    ioTasks = []
+    cpuTasks = []
+    badFiles = []
+    missingDirs = []
+    unresolved = []
+    nFiles = 0
+    with open(mapFilename) as mapFile:
+        for line in mapFile:
+            m = re.match(r'^(.*) <= \[(.*)\]$', line.rstrip('\r\n'))
+            if not m:
+                continue
+            relPath, folder = m.groups()
+            dst = os.path.normpath(os.path.join(targetFolder, relPath))
+            if dst in generated:
+                continue
+            src = resolveMapEntry(relPath, folder, manifest)
+            if src is None:
+                unresolved.append(dst)
+            elif src not in manifest:  # A directory
+                if os.path.isdir(src) and not os.path.isdir(dst):
+                    missingDirs.append(dst)
+            else:
+                nFiles += 1
+                task = (g_blobStore.resolve(src), dst, getWrapType(folder, src), manifest.hashName, manifest[src])
+                if not os.path.isfile(dst):
+                    badFiles.append(task)
+                elif task[2] == WRAP_TOTAL:
+                    cpuTasks.append(task)
+                else:
+                    ioTasks.append(task)
+    for task, ok in runPoolTasks(verifyTasks, ioTasks, cpuTasks, jobs):
+        if not ok:
+            badFiles.append(task)
+    badFiles.sort(key=lambda t: t[1])
+    for d in missingDirs:
+        g_dbg.trace('missingDir("{}")'.format(d))
+    for t in badFiles:
+        g_dbg.trace('badFile("{}" <= "{}")'.format(t[1], t[0]))
+    for d in unresolved:
+        g_dbg.trace('unresolvedSource("{}")'.format(d))
+    print('> Verified {} files ({:.1f} sec): {} bad, {} missing folders, {} without a known source.'.format(
+          nFiles, time.time() - startTime, len(badFiles), len(missingDirs), len(unresolved)))
+    for t in badFiles:
+        print('BAD: {}'.format(os.path.relpath(t[1], targetFolder)))
+    for d in missingDirs:
+        print('MISSING FOLDER: {}'.format(os.path.relpath(d, targetFolder)))
+    if repair and (badFiles or missingDirs):
+        print('> Repairing ...')
+        sys.stdout.flush()
+        for d in missingDirs:
+            mkTree(d)
+        expected = {}
+        ioTasks = []
+        cpuTasks = []
+        for src, dst, wrap, hashName, cksum in badFiles:
+            rmLinkedFile(dst)
+            expected[dst] = cksum
+            (cpuTasks if wrap == WRAP_TOTAL else ioTasks).append((src, dst, wrap, hashName, None))
+        # Compiling checksums each source, which tells us whether the module file
+        # itself differs from the release (in which case the repair can't help).
+        badFiles = [dst for dst, cksum, stats in runPoolTasks(compileTasks, ioTasks, cpuTasks, jobs)
+                    if cksum != expected[dst]]
+        missingDirs = []
+        print('> Repaired ({} files still differ from the release in modules/).'.format(len(badFiles)))
+        for dst in sorted(badFiles):
+            print('BAD SOURCE: {}'.format(os.path.relpath(dst, targetFolder)))
+    g_dbg.pop()
+    return 0 if not badFiles and not missingDirs else 3
+
+
 def buildModFilename(baseFolder, modBasename):
     modFilename = modBasename + '.mod'
     # CKII command line argument parser can't handle dashes in .mod file names
@@ -761,25 +2275,35 @@ def buildModFilename(baseFolder, modBasename):
     return modFilename
 
 
-def removePreexistingMod(targetFolder, modFilename):
-    # Remove preexisting target folder...
-    if os.path.exists(targetFolder):
+# The preexisting target folder is tombstoned (see Reaper) and deleted in the
+# background once compilation starts, or restored if the install is aborted
+# before then.
+def removePreexistingMod(targetFolder, modFilename, keepFolder=False):
+    g_prof.start('remove')
+    # Remove preexisting target folder (unless it's to be updated incrementally)...
+    if os.path.exists(targetFolder) and not keepFolder:
         if not g_steamMode:
             print()
-        print("> Removing preexisting '%s' ..." % targetFolder)
-        sys.stdout.flush()
-        startTime = time.time()
-        rmTree(targetFolder, 'rm_preexisting_mod("{}")'.format(targetFolder))
-        endTime = time.time()
-        print('> Removed (%0.1f sec).\n' % (endTime - startTime))
+        g_dbg.trace('rm_preexisting_mod("{}")'.format(targetFolder))
+        if g_reaper.removeDeferred(targetFolder):
+            print("> Removing preexisting '%s' in the background.\n" % targetFolder)
+        else:
+            print("> Removing preexisting '%s' ..." % targetFolder)
+            sys.stdout.flush()
+            startTime = time.time()
+            rmTree(targetFolder)
+            endTime = time.time()
+            print('> Removed (%0.1f sec).\n' % (endTime - startTime))
         sys.stdout.flush()
     # Remove preexisting .mod file...
     if os.path.exists(modFilename):
         rmFile(modFilename)
+    g_prof.stop('remove')
 
 
 def scaffoldMod(modFilename, targetFolder, modBasename, modName, modPath, modUserDir=None, eu4Version=None, deps=None):
-    mkTree(targetFolder)
+    if not os.path.isdir(targetFolder):
+        mkTree(targetFolder)
     # Generate a new .mod file...
     g_dbg.trace('write_dot_mod("{}")'.format(modFilename))
     with open(modFilename, 'w') as modFile:
@@ -808,12 +2332,597 @@ def scaffoldMod(modFilename, targetFolder, modBasename, modName, modPath, modUse
 # dependencies = { "\\"HIP - Historical Immersion Project\\"" "\\"HIP (Steam Edition)\\"" }''')
 
 
+# Modules that can be selected for an install, in the order they're listed in
+# a ModuleSelection's names()
+g_moduleNames = ['EMF', 'ARKOCoA', 'ARKOInt', 'ARKOInt768', 'ArumbaKS', 'CPR', 'SWMH', 'uSWMH', 'SED', 'LTM',
+                 'Converter']
+
+
+# Which modules to install, as attributes named per g_moduleNames, e.g.
+# ModuleSelection(SWMH=True, SED=True).
+class ModuleSelection:
+    def __init__(self, **selected):
+        for name in g_moduleNames:
+            setattr(self, name, bool(selected.pop(name, False)))
+        if selected:
+            raise InstallerUnknownModuleError(sorted(selected)[0])
+
+    def names(self):
+        return [name for name in g_moduleNames if getattr(self, name)]
+
+    # The same selection along with the modules that its modules depend upon
+    # (the prompts only offer these when their dependency was selected).
+    def implied(self):
+        s = ModuleSelection(**dict.fromkeys(self.names(), True))
+        s.SWMH |= s.uSWMH or s.SED or s.Converter
+        s.ARKOInt |= s.ARKOInt768
+        return s
+
+
+# Every distinct ModuleSelection that an install could be planned for
+def allModuleSelections():
+    seen = set()
+    for bits in range(1 << len(g_moduleNames)):
+        names = [name for i, name in enumerate(g_moduleNames) if bits & (1 << i)]
+        s = ModuleSelection(**dict.fromkeys(names, True)).implied()
+        if tuple(s.names()) not in seen:
+            seen.add(tuple(s.names()))
+            yield s
+
+
+def getModBasename(targetFolder):
+    return 'HIP_' + targetFolder if targetFolder != g_defaultFolder else 'HIP'
+
+
+def getConverterTargetFolder(targetFolder):
+    return getModBasename(targetFolder) + '_Converter'
+
+
+g_installPlanVersion = 1
+
+
+# Everything needed to install a module selection to targetFolder: the target
+# files (a TargetVFS, with the size and mtime of each file's source as recorded
+# in the install state file, unless those are None until applied), the mod's
+# names, and the contents of its version.txt and e_null.txt flags. It's built
+# by planInstall() without touching the target folders, and carried out by
+# applyPlan().
+class InstallPlan:
+    def __init__(self, selection, targetFolder, targetSrc, srcStats, moduleOutput, globalFlags):
+        self.selection = selection
+        self.targetFolder = targetFolder
+        self.modBasename = getModBasename(targetFolder)
+        if targetFolder != g_defaultFolder:
+            self.converterName = 'HIP - ' + targetFolder + ' - Converter'
+            self.modName = 'HIP - ' + targetFolder
+        else:
+            self.converterName = 'HIP - Converter'
+            self.modName = 'HIP - ' + targetFolder.replace('_', ' ')
+        self.converterTargetFolder = getConverterTargetFolder(targetFolder)
+        s = selection
+        self.modUserDir = self.modBasename if s.EMF or s.ARKOCoA or s.ARKOInt or s.CPR or s.SWMH else None
+        self.targetSrc = targetSrc
+        self.srcStats = srcStats
+        self.moduleOutput = moduleOutput
+        self.globalFlags = globalFlags
+
+    def toDict(self):
+        entries = []
+        for dst in sorted(self.targetSrc):
+            src = self.targetSrc[dst]
+            size, mtime = (self.srcStats or {}).get(dst, (None, None))
+            entries.append({'path': dst, 'module': src.folder, 'source': src.srcPath, 'layer': src.layer,
+                            'dir': src.isDir, 'wrap': src.wrap, 'size': size, 'mtime': mtime})
+        return {'version': g_installPlanVersion,
+                'modules': self.selection.names(),
+                'targetFolder': self.targetFolder,
+                'moduleOutput': self.moduleOutput,
+                'globalFlags': self.globalFlags,
+                'layers': self.targetSrc.layers,
+                'entries': entries}
+
+
+def installPlanFromDict(d):
+    if d.get('version') != g_installPlanVersion:
+        raise ValueError('unsupported version {}'.format(d.get('version')))
+    targetSrc = TargetVFS()
+    targetSrc.layers = [fromJSONString(l) for l in d['layers']]
+    srcStats = {}
+    for e in d['entries']:
+        src = TargetSource(fromJSONString(e['module']), fromJSONString(e['source']), isDir=e['dir'], wrap=e['wrap'])
+        targetSrc[fromJSONString(e['path'])] = src
+        src.layer = e['layer']
+        if not e['dir']:
+            srcStats[fromJSONString(e['path'])] = (e['size'], e['mtime'])
+    if any(size is None for size, mtime in srcStats.values()):  # Saved before being statted
+        srcStats = None
+    selection = ModuleSelection(**dict((str(name), True) for name in d['modules']))
+    return InstallPlan(selection, fromJSONString(d['targetFolder']), targetSrc, srcStats,
+                       [fromJSONString(l) for l in d['moduleOutput']], [fromJSONString(f) for f in d['globalFlags']])
+
+
+# Writes plan as JSON to filename, or to stdout if it's '-'
+def saveInstallPlan(plan, filename):
+    g_dbg.trace('saveInstallPlan("{}")'.format(filename))
+    if filename == '-':
+        json.dump(plan.toDict(), sys.stdout, indent=2, separators=(',', ': '), sort_keys=True)
+        print()
+        return
+    with open(filename, 'w') as f:
+        json.dump(plan.toDict(), f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+
+def loadInstallPlan(filename):
+    g_dbg.trace('loadInstallPlan("{}")'.format(filename))
+    try:
+        with open(filename) as f:
+            return installPlanFromDict(json.load(f))
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        raise InstallerPlanError(filename, e)
+
+
+# Merges the module folders of selection (and those it implies; see
+# ModuleSelection) into the InstallPlan for an install to targetFolder. The
+# module index, if any, should be loaded beforehand. The sources are only
+# statted if stat is set; otherwise, applyPlan() does so once they're needed.
+def planInstall(selection, targetFolder=g_defaultFolder, stat=False):
+    global g_targetSrc
+    if not g_versions:
+        getPkgVersions(g_modVersionDirs)
+    selection = selection.implied()
+    EMF, ARKOCoA, ARKOInt, ARKOInt768, ArumbaKS, CPR, SWMH, uSWMH, SED, LTM, Converter = \
+        [getattr(selection, name) for name in g_moduleNames]
+    converterTargetFolder = getConverterTargetFolder(targetFolder)
+    g_prof.start('merge')
+    g_targetSrc = TargetVFS()
+    moduleOutput = ['[ HIP Release: {} ]\n'.format(g_versions['pkg'])]
+    globalFlags = []
+    g_dbg.push('merge_all')
+    if EMF:
+        globalFlags.append('EMF_prestartup')
+        moduleOutput.append('EMF: Extended Mechanics & Flavor (%s)\n' % g_versions['EMF'])
+    if ArumbaKS:
+        g_dbg.push('merge(ArumbaKS)')
+        globalFlags.append('AKS')
+        moduleOutput.append('Arumba and Internal Tab Shortcuts (%s)\n' % g_versions['ArumbaKS'])
+        pushFolder('ArumbaKS', targetFolder)
+        g_dbg.pop()
+    if ARKOInt:
+        g_dbg.push("merge('ARKO Interface')")
+        globalFlags.append('ArkoUI')
+        moduleOutput.append("ARKO Interface (%s)\n" % g_versions['ARKOI'])
+        pushFolder('ARKOpack_Interface', targetFolder)
+        if ArumbaKS:
+            pushFolder('ArkoInterface+AKS', targetFolder)
+        if ARKOInt768:
+            pushFolder('ARKOpack_Interface_768', targetFolder)
+            if ArumbaKS:
+                pushFolder('ArkoInterface768+AKS', targetFolder)
+        g_dbg.pop()
+    if SWMH:
+        g_dbg.push('merge(SWMH)')
+        globalFlags.append('SWMH')
+        moduleOutput.append('SWMH (%s)\n' % g_versions['SWMH'])
+        pushFolder('SWMH', targetFolder)
+        g_dbg.pop()
+    if uSWMH:
+        g_dbg.push('merge(uSWMH)')
+        globalFlags.append('MiniSWMH')
+        moduleOutput.append('MiniSWMH: Performance-Friendly SWMH (%s)\n' % g_versions['uSWMH'])
+        pushFolder('MiniSWMH', targetFolder)
+        g_dbg.pop()
+    if SED:
+        g_dbg.push('merge(SED)')
+        globalFlags.append('SED')
+        moduleOutput.append('SED: English Localisation for SWMH (%s)\n' % g_versions['SED'])
+        pushFolder('SED2', targetFolder)
+        if EMF:
+            pushFolder('SED2+EMF', targetFolder)
+        if uSWMH:
+            pushFolder('SED2+MiniSWMH', targetFolder)
+        g_dbg.pop()
+    if ARKOCoA:
+        g_dbg.push("merge('ARKO CoA')")
+        globalFlags.append('ArkoCoA')
+        moduleOutput.append('ARKO Armoiries (%s)\n' % g_versions['ARKOC'])
+        pushFolder('ARKOpack_Armoiries', targetFolder)
+        if SWMH:
+            pushFolder('SWMH/gfx/flags', os.path.join(targetFolder, 'gfx', 'flags'))
+        g_dbg.pop()
+    if LTM:
+        g_dbg.push('merge(LTM)')
+        globalFlags.append('LTM')
+        moduleOutput.append('LTM (%s)\n' % g_versions['LTM'])
+        if SWMH:
+            pushFolder('LTM+SWMH', targetFolder)
+        else:
+            pushFolder('LTM+Vanilla', targetFolder)
+        if ARKOCoA:
+            pushFolder('ArkoCoA+LTM', targetFolder)
+        g_dbg.pop()
+    if EMF:
+        g_dbg.push('merge(EMF)')
+        pushFolder('EMF', targetFolder)
+        if SWMH:
+            pushFolder('EMF+SWMH', targetFolder)
+            if uSWMH:
+                pushFolder('EMF+MiniSWMH', targetFolder)
+        else:
+            pushFolder('EMF+Vanilla', targetFolder)
+        if ArumbaKS:
+            pushFolder('EMF+AKS', targetFolder)
+        if ARKOInt:
+            pushFolder('EMF+ArkoInterface', targetFolder)
+            if ArumbaKS:
+                pushFolder('EMF+ArkoInterface+AKS', targetFolder)
+        g_dbg.pop()
+    if CPR:
+        g_dbg.push('merge(CPR)')
+        globalFlags.append('CPR')
+        moduleOutput.append('CPRplus (%s)\n' % g_versions['CPR'])
+        pushFolder('CPRplus', targetFolder, wrapPaths=g_moduleWrapPaths['CPRplus'])
+        if SWMH:
+            pushFolder('CPRplus-compatch/SWMH', targetFolder)
+        elif EMF:
+            pushFolder('CPRplus-compatch/EMF', targetFolder)
+        g_dbg.pop()
+    if Converter:
+        g_dbg.push('merge(Converter)')
+        moduleOutput.append('Converter (%s)\n' % g_versions['Converter'])
+        pushFolder('Converter', converterTargetFolder)
+        if uSWMH:
+            pushFolder('Converter+Mini', converterTargetFolder)
+        g_dbg.pop()
+    g_dbg.pop('merge_done')
+    g_prof.stop('merge')
+    srcStats = None
+    if stat:
+        g_prof.start('sourceStat')
+        srcStats = statTargetSources()
+        g_prof.stop('sourceStat')
+    return InstallPlan(selection, targetFolder, g_targetSrc, srcStats, moduleOutput, globalFlags)
+
+
+# The plan of every module combination is baked into modules/install_plans.bin
+# at release time (see shrinkwrap.py), so the installer needn't merge module
+# folders itself. Target files are entries of a shared table, and each plan is
+# the entries it adds to and removes from a base plan (one with fewer modules),
+# so that identical plans and the overlap of similar ones are only stored once.
+# The file is a header, a compressed JSON directory, then the compressed table
+# (a line of tab-separated fields per entry) and JSON plan blobs, at the
+# offsets the directory gives.
+g_bakedPlansFilename = 'install_plans.bin'
+g_bakedPlansMagic = b'HIPPLANS'
+g_bakedPlansVersion = 1
+g_bakedPlansHeader = '<8sHI'  # magic, version, directory length
+
+
+def getBakedPlanKey(selection):
+    return ','.join(selection.implied().names())
+
+
+def fromJSONString(s):  # Py2's json gives unicode strings; keep to str like os.walk() would
+    return s.encode('utf-8') if sys.version_info[0] < 3 else s
+
+
+# Bakes the plan of every combination of the modules in modules/ into the
+# baked plans file there, stamped with the manifest's time like the module index
+# (which should be loaded beforehand, as planning otherwise walks every folder).
+def bakeInstallPlans(manifestTime):
+    g_dbg.push('bakeInstallPlans')
+    roots = [g_defaultFolder, getConverterTargetFolder(g_defaultFolder)]
+    entryIds = {}  # Table entry => index
+    blobs = []  # Plan blobs as dicts
+    blobIds = {}  # (digest of entries, layers, moduleOutput, globalFlags) => blob index
+    # (module names, sorted entry ids, blob index) of the plans baked so far
+    # that could still be bases, i.e. that have at most two fewer modules than
+    # the selection being planned. Selections are planned in order of their
+    # number of modules, so only a few plans' ids are ever kept at once.
+    baked = []
+    planIds = {}
+    for selection in sorted(allModuleSelections(), key=lambda s: len(s.names())):
+        plan = planInstall(selection)
+        names = set(selection.names())
+        baked = [b for b in baked if len(b[0]) >= len(names) - 2]
+        ids = set()
+        for dst, src in plan.targetSrc.items():
+            root = 0 if dst.startswith(roots[0] + os.sep) else 1
+            entry = (root, dst[len(roots[root]) + 1:].replace(os.sep, '/'), src.folder.replace(os.sep, '/'),
+                     src.srcPath[len(g_manifestPathPrefix):].replace(os.sep, '/'), src.isDir, src.wrap)
+            ids.add(entryIds.setdefault(entry, len(entryIds)))
+        layers = [l.replace(os.sep, '/') for l in plan.targetSrc.layers]
+        sortedIds = array.array('I', sorted(ids))
+        digest = hashlib.md5(sortedIds.tobytes() if hasattr(sortedIds, 'tobytes') else sortedIds.tostring()).digest()
+        contents = (digest, tuple(layers), tuple(plan.moduleOutput), tuple(plan.globalFlags))
+        if contents not in blobIds:
+            base, baseIds, baseDiff = None, (), len(ids)
+            for baseNames, otherIds, i in baked:
+                if baseNames < names:
+                    diff = len(ids) + len(otherIds) - 2 * len(ids.intersection(otherIds))
+                    if diff < baseDiff:
+                        base, baseIds, baseDiff = i, otherIds, diff
+            baseIds = set(baseIds)
+            blobIds[contents] = len(blobs)
+            blobs.append({'base': base, 'add': sorted(ids - baseIds), 'remove': sorted(baseIds - ids),
+                          'layers': layers, 'moduleOutput': plan.moduleOutput, 'globalFlags': plan.globalFlags})
+            baked.append((names, sortedIds, blobIds[contents]))
+        planIds[getBakedPlanKey(selection)] = blobIds[contents]
+    table = [None] * len(entryIds)
+    for entry, i in entryIds.items():
+        table[i] = '\t'.join(str(x) for x in entry[:2]) + '\t' + '\t'.join(entry[2:4]) + \
+                   '\t{:d}\t{}'.format(entry[4], entry[5])
+    table = '\n'.join(table)
+    if not isinstance(table, bytes):
+        table = table.encode('utf-8')
+    data = [zlib.compress(table, 9)]
+    data += [zlib.compress(json.dumps(b, separators=(',', ':')).encode('utf-8'), 9) for b in blobs]
+    offsets = []
+    offset = 0
+    for d in data:
+        offsets.append([offset, len(d)])
+        offset += len(d)
+    directory = {'time': manifestTime, 'table': offsets[0], 'blobs': offsets[1:], 'plans': planIds}
+    directory = zlib.compress(json.dumps(directory, separators=(',', ':'), sort_keys=True).encode('utf-8'), 9)
+    path = os.path.join('modules', g_bakedPlansFilename)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(struct.pack(g_bakedPlansHeader, g_bakedPlansMagic, g_bakedPlansVersion, len(directory)))
+        f.write(directory)
+        for d in data:
+            f.write(d)
+    if os.path.exists(path):
+        os.unlink(path)  # Py2 can't rename over an existing file on Windows
+    os.rename(path + '.tmp', path)
+    g_dbg.pop('numPlans(combinations={}, distinct={}, entries={})'.format(len(planIds), len(blobs), len(entryIds)))
+    return len(planIds), len(blobs), len(entryIds)
+
+
+# Returns the baked plan for an install of selection to targetFolder, or None
+# if there's no usable one (which is always the case if it's not from the same
+# release as the manifest, or an EMF beta was applied).
+def loadBakedPlan(selection, targetFolder, manifestTime):
+    path = os.path.join('modules', g_bakedPlansFilename)
+    g_dbg.push('loadBakedPlan("{}")'.format(path))
+    if not os.path.exists(path):
+        g_dbg.pop('bakedPlansNotFound')
+        return None
+    try:
+        with open(path, 'rb') as f:
+            headerLen = struct.calcsize(g_bakedPlansHeader)
+            magic, version, directoryLen = struct.unpack(g_bakedPlansHeader, f.read(headerLen))
+            if magic != g_bakedPlansMagic or version != g_bakedPlansVersion:
+                g_dbg.pop('bakedPlansVersionMismatch')
+                return None
+            directory = json.loads(zlib.decompress(f.read(directoryLen)).decode('utf-8'))
+            if manifestTime is None or directory['time'] != manifestTime:
+                g_dbg.pop('bakedPlansStale')
+                return None
+            key = getBakedPlanKey(selection)
+            if key not in directory['plans']:
+                g_dbg.pop('bakedPlanNotFound("{}")'.format(key))
+                return None
+            dataStart = headerLen + directoryLen
+
+            def readBlob(offset, length):
+                f.seek(dataStart + offset)
+                return json.loads(zlib.decompress(f.read(length)).decode('utf-8'))
+
+            chain = []
+            i = directory['plans'][key]
+            while i is not None:
+                chain.append(readBlob(*directory['blobs'][i]))
+                i = chain[-1]['base']
+            f.seek(dataStart + directory['table'][0])
+            table = zlib.decompress(f.read(directory['table'][1]))
+    except (IOError, OSError, struct.error, zlib.error, ValueError, KeyError, TypeError) as e:
+        g_dbg.pop('failureLoadingBakedPlans("{}")'.format(e))
+        return None
+    ids = set()
+    for blob in reversed(chain):
+        ids.difference_update(blob['remove'])
+        ids.update(blob['add'])
+    roots = [targetFolder, getConverterTargetFolder(targetFolder)]
+    targetSrc = TargetVFS()
+    targetSrc.layers = [os.path.normpath(fromJSONString(l)) for l in chain[0]['layers']]
+    layerIds = dict((l, i) for i, l in enumerate(targetSrc.layers))
+    if sys.version_info[0] >= 3:
+        table = table.decode('utf-8')
+    if os.sep != '/':
+        table = table.replace('/', os.sep)
+    table = table.split('\n')
+    roots = [r + os.sep for r in roots]
+    srcPrefix = g_manifestPathPrefix
+    for i in ids:
+        root, relPath, folder, srcPath, isDir, wrap = table[i].split('\t')
+        src = TargetSource(folder, srcPrefix + srcPath, isDir == '1', int(wrap))
+        targetSrc[roots[int(root)] + relPath] = src
+        src.layer = layerIds.get(folder, -1)
+    g_dbg.pop('bakedPlanSize({})'.format(len(targetSrc)))
+    return InstallPlan(selection.implied(), targetFolder, targetSrc, None,
+                       [fromJSONString(l) for l in chain[0]['moduleOutput']],
+                       [fromJSONString(flag) for flag in chain[0]['globalFlags']])
+
+
+# Installs plan: compiles its target files, writes its .mod files, and resets
+# the HIP-related CKII caches. If incremental is set, a preexisting target
+# folder is updated in place when its install state is usable (see
+# pruneTarget); otherwise, the install is compiled into staging folders that
+# only replace the preexisting ones once it's complete. Resetting the caches
+# can be skipped with clearCaches, e.g. when benchmarking.
+def applyPlan(plan, manifest, jobs=1, link=None, incremental=False, clearCaches=True):
+    global g_targetSrc
+    global g_modified
+    g_targetSrc = plan.targetSrc
+    g_modified = False
+    hashName = manifest.hashName if manifest else None
+    targetFolder = plan.targetFolder
+    converterTargetFolder = plan.converterTargetFolder
+    moduleOutput = list(plan.moduleOutput)
+    modFilename = buildModFilename('.', plan.modBasename)
+    euModFilename = buildModFilename('.', converterTargetFolder)
+    # Finish deleting any folders that a previous run removed in the background
+    reapTombstones('.')
+    # An incremental install updates a preexisting targetFolder in place,
+    # if the state of its last completed install is known.
+    prevState = loadInstallState(targetFolder, hashName) if incremental else None
+
+    def removeMods(keepTarget, keepConverter):
+        removePreexistingMod(targetFolder, modFilename, keepFolder=keepTarget)
+        # Also remove old space-separated default folder for giggles and to
+        # avoid ambiguity, if it's there (and isn't what we're installing to)
+        if g_spacedDefaultFolder not in (targetFolder, converterTargetFolder):
+            removePreexistingMod(g_spacedDefaultFolder, modFilename)
+        removePreexistingMod(converterTargetFolder, euModFilename, keepFolder=keepConverter)
+
+    def scaffoldMods():
+        scaffoldMod(modFilename,
+                    targetFolder,
+                    plan.modBasename,
+                    plan.modName,
+                    targetFolder,
+                    plan.modUserDir)
+        if plan.selection.Converter:
+            scaffoldMod(euModFilename,
+                        converterTargetFolder,
+                        converterTargetFolder,
+                        plan.converterName,
+                        converterTargetFolder,
+                        deps=[plan.modName])
+
+    # Otherwise, the install is compiled into staging folders, and the
+    # previous install is only replaced once it's complete.
+    staged = prevState is None
+    if staged:
+        stageFolder(targetFolder)
+        if plan.selection.Converter:
+            stageFolder(converterTargetFolder)
+    else:
+        removeMods(True, False)
+        scaffoldMods()
+    # Where to dump a mapping of all the compiled files to their source modules (will include stuff from outside
+    # targetFolder for now too if such stuff is pushed on to the virtual filesystem)
+    mapFilename = os.path.join(targetFolder, "file2mod_map.txt")
+    startTime = time.time()
+    # A plan's sources are only statted once they're needed (unless it was
+    # planned with stat set), which for a fresh install is after they've been
+    # compiled
+    srcStats = plan.srcStats
+    skip = None
+    if prevState is not None:
+        if srcStats is None:
+            g_prof.start('sourceStat')
+            srcStats = statTargetSources()
+            g_prof.stop('sourceStat')
+        g_prof.start('prune')
+        skip = pruneTarget(targetFolder, prevState, srcStats, manifest)
+        g_prof.stop('prune')
+        # Past the point of no return, so the preexisting target folders can go
+        g_reaper.commit()
+    # Do all the actual compilation (file I/O)
+    g_prof.start('compile')
+    cksums = compileTarget(stagedPath(mapFilename), targetFolder, manifest, jobs, skip, link)
+    g_prof.stop('compile')
+    if srcStats is None:
+        g_prof.start('sourceStat')
+        srcStats = statTargetSources()
+        g_prof.stop('sourceStat')
+    saveInstallState(stagedPath(targetFolder), srcStats, cksums, hashName)
+    endTime = time.time()
+    print('> Compiled (%0.1f sec).\n' % (endTime - startTime))
+    # Report if the installed files didn't match release manifest checksum:
+    if g_modified:
+        msg = '''
+ERROR: Some installed files do not match their released version. This means that
+       your HIP installation will not be working as designed and is indeed
+       corrupted. This issue is caused by either of the following:
+
+A) Not deleting the previous HIP installation's "modules/" folder before
+   extracting the new HIP release archive.
+B) Modifying or adding new files inside the "modules/" folder directly when you
+   should be using a personal submod to override/change HIP files. Note that
+   installing an EMF Beta from the proper source cannot cause this issue.
+'''
+        moduleOutput.append(msg)
+        print(msg)
+        print()
+    if not g_steamMode:
+        print('Mapping of all compiled mod files to their HIP source modules:')
+        print(mapFilename)
+        print()
+    # Dump modules selected and their respective g_versions to <mod>/version.txt
+    versionFilename = os.path.join(targetFolder, 'version.txt')
+    rmLinkedFile(stagedPath(versionFilename))
+    with open(stagedPath(versionFilename), 'w') as output:
+        output.write(''.join(moduleOutput))
+    print('Summary of mod combination & versions (INCLUDE THIS FILE IN BUG REPORTS):')
+    print(versionFilename)
+    print()
+    # Add global flags for runtime module identification:
+    flagDir = stagedPath(os.path.join(targetFolder, os.path.normpath('history/titles')))
+    flagPath = os.path.join(flagDir, 'e_null.txt')
+    if os.path.exists(flagDir):
+        rmLinkedFile(flagPath)
+        with open(flagPath, 'w') as of:
+            of.write('# -*- ck2.history.titles -*-\n')
+            of.write('476.1.1 = {\n')
+            for flag in plan.globalFlags:
+                of.write('\tset_global_flag = {}\n'.format(flag))
+            of.write('}\n')
+    if staged:
+        g_prof.start('swap')
+        syncStagedFolders(jobs)
+        swapStagedFolders()
+        g_prof.stop('swap')
+        # Past the point of no return, so what the swap didn't replace can go
+        # too (removeMods never removes the swapped-in folders), and the .mod
+        # files can be rewritten
+        removeMods(True, plan.selection.Converter)
+        scaffoldMods()
+        g_reaper.commit()
+    # Reset all gfx/map/interface/logs cache for every instance of a preexisting
+    # user_dir that includes HIP, platform-agnostic.
+    if clearCaches:
+        g_prof.start('cacheReset')
+        resetCaches()
+        g_prof.stop('cacheReset')
+
+
+def finishInstall(batchMode):
+    g_dbg.trace('install_done')
+    if batchMode:
+        print('DONE!')
+    else:
+        promptUser(localise('INSTALL_DONE'))
+    # Let the caches finish being deleted in the background before exiting,
+    # lest the interpreter's shutdown kill the Reaper's threads mid-way
+    g_prof.start('reaperWait')
+    g_reaper.wait()
+    g_prof.stop('reaperWait')
+
+
+g_profileFilename = 'HIP_profile.json'
+
+
+def writeProfile(jobs, link, hashName):
+    g_prof.stop('total')
+    g_prof.report(g_profileFilename, {'version': g_versions.get('pkg'),
+                                      'python': sys.version.split()[0],
+                                      'platform': g_platform,
+                                      'jobs': jobs,
+                                      'link': link,
+                                      'hash': hashName,
+                                      'unwrapEngine': g_unwrapEngine})
+
+
 def main():
     try:
         initVersionEnvInfo()
         global g_steamMode
         g_steamMode = '--steam' in sys.argv[1:]
-        dbgMode = '-D' in sys.argv[1:] or '--debug' in sys.argv[1:]
+        g_prof.start('total')
+        dbgSample = getDebugSample()
+        dbgMode = dbgSample > 1 or '-D' in sys.argv[1:] or '--debug' in sys.argv[1:]
+        profileMode = '--profile' in sys.argv[1:]
         versionMode = '-V' in sys.argv[1:] or '--version' in sys.argv[1:]
         inplaceMode = '--in-place' in sys.argv[1:]
         swmhSelect = '--swmh' in sys.argv[1:]
@@ -829,14 +2938,29 @@ def main():
         cprSelect = '--cpr' in sys.argv[1:]
         aksSelect = '--aks' in sys.argv[1:]
         uswmhSelect = '--mini' in sys.argv[1:]
+        incrementalMode = '--incremental' in sys.argv[1:]
+        noIndexMode = '--no-index' in sys.argv[1:]
+        repairMode = '--repair' in sys.argv[1:]
+        verifyMode = repairMode or '--verify' in sys.argv[1:]
+        planFilename = getOptionValue('--plan')
+        applyPlanFilename = getOptionValue('--apply-plan')
+        # A plan written to stdout must be all that's written there, so
+        # everything else (prompts included) goes to stderr meanwhile
+        planStdout = sys.stdout
+        if planFilename == '-':
+            sys.stdout = sys.stderr
+        jobs = getCompileJobs()
+        link = getLinkMode()
         # Are we in a batch mode?
         batchMode = sedSelect or swmhSelect or emfSelect or ltmSelect or arkocSelect or \
                     arkoiSelect or cprSelect or aksSelect or uswmhSelect or g_steamMode
         global g_dbg
-        g_dbg = DebugTrace(open('HIP_debug.log', 'w'), prefix='') if dbgMode else NullDebugTrace()
+        g_dbg = DebugTrace(open('HIP_debug.log', 'w'), prefix='', sample=dbgSample) if dbgMode else NullDebugTrace()
         global g_platform
         g_platform = detectPlatform()
         g_dbg.trace('platform({})'.format(g_platform))
+        g_dbg.trace('jobs({})'.format(jobs))
+        g_dbg.trace('link({})'.format(link))
         if versionMode:
             printVersionEnvInfo()
             return 0
@@ -851,21 +2975,36 @@ def main():
         # Load release manifest:
         global g_modified
         g_modified = False
-        manifest = loadManifest()
-        # These are the modules/ directories from which to grab each mod's version.txt:
-        modDirs = {'pkg': '',   # Installer package version
-                   'SWMH':      'SWMH',
-                   'CPR':       'CPRplus',
-                   'EMF':       'EMF',
-                   'SED':       'SED2',
-                   'ARKOC':     'ARKOpack_Armoiries',
-                   'ARKOI':     'ARKOpack_Interface',
-                   'ArumbaKS':  'ArumbaKS',
-                   'uSWMH':     'MiniSWMH',
-                   'LTM':       'LTM+SWMH',
-                   'Converter': 'Converter'
-        }
-        getPkgVersions(modDirs)
+        g_prof.start('manifestLoad')
+        manifest, manifestTime, emfApplied = loadManifest()
+        g_prof.stop('manifestLoad')
+        hashName = manifest.hashName if manifest else None
+        g_dbg.trace('hash({})'.format(hashName))
+        # Load the blob index, through which module files deduplicated at release are found:
+        global g_blobStore
+        g_blobStore = loadBlobStore(emfApplied)
+        # Load the module index, which spares pushFolder from walking module folders:
+        global g_moduleIndex
+        g_prof.start('moduleIndex')
+        g_moduleIndex = None if noIndexMode else loadModuleIndex(manifestTime, emfApplied)
+        g_prof.stop('moduleIndex')
+        if verifyMode:
+            g_prof.start('verify')
+            rc = verifyInstall(getOptionValue('--folder', g_defaultFolder), manifest, jobs, repairMode)
+            g_prof.stop('verify')
+            if profileMode:
+                writeProfile(jobs, link, hashName)
+            return rc
+        # A plan saved by --plan is installed as is, without prompting:
+        if applyPlanFilename:
+            applyPlan(loadInstallPlan(applyPlanFilename), manifest, jobs, link, incrementalMode)
+            finishInstall(True)
+            if profileMode:
+                writeProfile(jobs, link, hashName)
+            return 0
+        g_prof.start('versionScan')
+        getPkgVersions(g_modVersionDirs)
+        g_prof.stop('versionScan')
         # Prompt user for options related to this install (not re: module selections):
         targetFolder = getInstallOptions(batchMode)
         if not g_steamMode:
@@ -913,9 +3052,11 @@ def main():
             LTM = True
         # K, let's get to prompting:
         cprMissingDLCNames = None
+        g_prof.start('dlcDetection')
         dlcIDs = detectDLCs()
         if dlcIDs is not None:
             cprMissingDLCNames = detectCPRMissingDLCs(dlcIDs)
+        g_prof.stop('dlcDetection')
         if batchMode:
             CPR &= cprMissingDLCNames is not None and len(cprMissingDLCNames) == 0
         else:
@@ -972,204 +3113,37 @@ If you want the vanilla map instead, simply type 'n' or 'no' for SWMH below:''')
                         Converter = enableModDefaultNo('Converter: EU4 conversion support for SWMH ({})'.format(g_versions['Converter']), compat=True)
             # LTM...
             LTM = enableMod('Lindbrook\'s Texture Map ({})'.format(g_versions['LTM']))
-        # Prepare for installation...
-        if targetFolder != g_defaultFolder:
-            modBasename = 'HIP_' + targetFolder
-            converterName = 'HIP - ' + targetFolder + ' - Converter'
-            modName = 'HIP - ' + targetFolder
-        else:
-            modBasename = 'HIP'
-            converterName = 'HIP - Converter'
-            modName = 'HIP - ' + targetFolder.replace('_', ' ')
-        converterTargetFolder = modBasename + '_Converter'
-        if EMF or ARKOCoA or ARKOInt or CPR or SWMH:
-            modUserDir = modBasename
-        else:
-            modUserDir = None
-        modFilename = buildModFilename('.', modBasename)
-        euModFilename = buildModFilename('.', converterTargetFolder)
-        removePreexistingMod(targetFolder, modFilename)
-        # Also remove old space-separated default folder for giggles and to
-        # avoid ambiguity, if it's there
-        removePreexistingMod(g_spacedDefaultFolder, modFilename)
-        removePreexistingMod(converterTargetFolder, euModFilename)
-        scaffoldMod(modFilename,
-                    targetFolder,
-                    modBasename,
-                    modName,
-                    targetFolder,
-                    modUserDir)
-        if Converter:
-            scaffoldMod(euModFilename,
-                        converterTargetFolder,
-                        converterTargetFolder,
-                        converterName,
-                        converterTargetFolder,
-                        deps=[modName])
-        # Prepare file mappings...
-        global g_targetSrc
-        g_targetSrc = {}
-        moduleOutput = ['[ HIP Release: {} ]\n'.format(g_versions['pkg'])]
-        globalFlags = []
-        g_dbg.push('merge_all')
-        if EMF:
-            globalFlags.append('EMF_prestartup')
-            moduleOutput.append('EMF: Extended Mechanics & Flavor (%s)\n' % g_versions['EMF'])
-        if ArumbaKS:
-            g_dbg.push('merge(ArumbaKS)')
-            globalFlags.append('AKS')
-            moduleOutput.append('Arumba and Internal Tab Shortcuts (%s)\n' % g_versions['ArumbaKS'])
-            pushFolder('ArumbaKS', targetFolder)
-            g_dbg.pop()
-        if ARKOInt:
-            g_dbg.push("merge('ARKO Interface')")
-            globalFlags.append('ArkoUI')
-            moduleOutput.append("ARKO Interface (%s)\n" % g_versions['ARKOI'])
-            pushFolder('ARKOpack_Interface', targetFolder)
-            if ArumbaKS:
-                pushFolder('ArkoInterface+AKS', targetFolder)
-            if ARKOInt768:
-                pushFolder('ARKOpack_Interface_768', targetFolder)
-                if ArumbaKS:
-                    pushFolder('ArkoInterface768+AKS', targetFolder)
-            g_dbg.pop()
-        if SWMH:
-            g_dbg.push('merge(SWMH)')
-            globalFlags.append('SWMH')
-            moduleOutput.append('SWMH (%s)\n' % g_versions['SWMH'])
-            pushFolder('SWMH', targetFolder)
-            g_dbg.pop()
-        if uSWMH:
-            g_dbg.push('merge(uSWMH)')
-            globalFlags.append('MiniSWMH')
-            moduleOutput.append('MiniSWMH: Performance-Friendly SWMH (%s)\n' % g_versions['uSWMH'])
-            pushFolder('MiniSWMH', targetFolder)
-            g_dbg.pop()
-        if SED:
-            g_dbg.push('merge(SED)')
-            globalFlags.append('SED')
-            moduleOutput.append('SED: English Localisation for SWMH (%s)\n' % g_versions['SED'])
-            pushFolder('SED2', targetFolder)
-            if EMF:
-                pushFolder('SED2+EMF', targetFolder)
-            if uSWMH:
-                pushFolder('SED2+MiniSWMH', targetFolder)
-            g_dbg.pop()
-        if ARKOCoA:
-            g_dbg.push("merge('ARKO CoA')")
-            globalFlags.append('ArkoCoA')
-            moduleOutput.append('ARKO Armoiries (%s)\n' % g_versions['ARKOC'])
-            pushFolder('ARKOpack_Armoiries', targetFolder)
-            if SWMH:
-                pushFolder('SWMH/gfx/flags', os.path.join(targetFolder, 'gfx', 'flags'))
-            g_dbg.pop()
-        if LTM:
-            g_dbg.push('merge(LTM)')
-            globalFlags.append('LTM')
-            moduleOutput.append('LTM (%s)\n' % g_versions['LTM'])
-            if SWMH:
-                pushFolder('LTM+SWMH', targetFolder)
-            else:
-                pushFolder('LTM+Vanilla', targetFolder)
-            if ARKOCoA:
-                pushFolder('ArkoCoA+LTM', targetFolder)
-            g_dbg.pop()
-        if EMF:
-            g_dbg.push('merge(EMF)')
-            pushFolder('EMF', targetFolder)
-            if SWMH:
-                pushFolder('EMF+SWMH', targetFolder)
-                if uSWMH:
-                    pushFolder('EMF+MiniSWMH', targetFolder)
-            else:
-                pushFolder('EMF+Vanilla', targetFolder)
-            if ArumbaKS:
-                pushFolder('EMF+AKS', targetFolder)
-            if ARKOInt:
-                pushFolder('EMF+ArkoInterface', targetFolder)
-                if ArumbaKS:
-                    pushFolder('EMF+ArkoInterface+AKS', targetFolder)
-            g_dbg.pop()
-        if CPR:
-            g_dbg.push('merge(CPR)')
-            globalFlags.append('CPR')
-            moduleOutput.append('CPRplus (%s)\n' % g_versions['CPR'])
-            wrappedPaths = set(['gfx'])
-            pushFolder('CPRplus', targetFolder, wrapPaths=wrappedPaths)
-            if SWMH:
-                pushFolder('CPRplus-compatch/SWMH', targetFolder)
-            elif EMF:
-                pushFolder('CPRplus-compatch/EMF', targetFolder)
-            g_dbg.pop()
-        if Converter:
-            g_dbg.push('merge(Converter)')
-            moduleOutput.append('Converter (%s)\n' % g_versions['Converter'])
-            pushFolder('Converter', converterTargetFolder)
-            if uSWMH:
-                pushFolder('Converter+Mini', converterTargetFolder)
-            g_dbg.pop()
-        g_dbg.pop('merge_done')
-        # Where to dump a mapping of all the compiled files to their source modules (will include stuff from outside
-        # targetFolder for now too if such stuff is pushed on to the virtual filesystem)
-        mapFilename = os.path.join(targetFolder, "file2mod_map.txt")
-        startTime = time.time()
-        # Do all the actual compilation (file I/O)
-        compileTarget(mapFilename, targetFolder, manifest)
-        endTime = time.time()
-        print('> Compiled (%0.1f sec).\n' % (endTime - startTime))
-        # Report if the installed files didn't match release manifest checksum:
-        if g_modified:
-            msg = '''
-ERROR: Some installed files do not match their released version. This means that
-       your HIP installation will not be working as designed and is indeed
-       corrupted. This issue is caused by either of the following:
-
-A) Not deleting the previous HIP installation's "modules/" folder before
-   extracting the new HIP release archive.
-B) Modifying or adding new files inside the "modules/" folder directly when you
-   should be using a personal submod to override/change HIP files. Note that
-   installing an EMF Beta from the proper source cannot cause this issue.
-'''
-            moduleOutput.append(msg)
-            print(msg)
-            print()
-        if not g_steamMode:
-            print('Mapping of all compiled mod files to their HIP source modules:')
-            print(mapFilename)
-            print()
-        # Dump modules selected and their respective g_versions to <mod>/version.txt
-        versionFilename = os.path.join(targetFolder, 'version.txt')
-        with open(versionFilename, 'w') as output:
-            output.write(''.join(moduleOutput))
-        print('Summary of mod combination & versions (INCLUDE THIS FILE IN BUG REPORTS):')
-        print(versionFilename)
-        print()
-        # Add global flags for runtime module identification:
-        flagDir = os.path.join(targetFolder, os.path.normpath('history/titles'))
-        flagPath = os.path.join(flagDir, 'e_null.txt')
-        if os.path.exists(flagDir):
-            with open(flagPath, 'w') as of:
-                of.write('# -*- ck2.history.titles -*-\n')
-                of.write('476.1.1 = {\n')
-                for flag in globalFlags:
-                    of.write('\tset_global_flag = {}\n'.format(flag))
-                of.write('}\n')
-        # Reset all gfx/map/interface/logs cache for every instance of a preexisting
-        # user_dir that includes HIP, platform-agnostic.
-        resetCaches()
-        g_dbg.trace('install_done')
-        if batchMode:
-            print('DONE!')
-        else:
-            promptUser(localise('INSTALL_DONE'))
+        selection = ModuleSelection(EMF=EMF, ARKOCoA=ARKOCoA, ARKOInt=ARKOInt, ARKOInt768=ARKOInt768,
+                                    ArumbaKS=ArumbaKS, CPR=CPR, SWMH=SWMH, uSWMH=uSWMH, SED=SED, LTM=LTM,
+                                    Converter=Converter)
+        # Baked plans are built from the module index, so they're only used if
+        # none of it is stale (which it is for the EMF folders if an EMF beta
+        # was applied, or for any module folder added to since the release)
+        plan = None
+        if g_moduleIndex is not None and not g_moduleIndex.staleFolders:
+            g_prof.start('planLoad')
+            plan = loadBakedPlan(selection, targetFolder, manifestTime)
+            g_prof.stop('planLoad')
+        if plan is None:
+            plan = planInstall(selection, targetFolder)
+        if planFilename:
+            sys.stdout = planStdout
+            saveInstallPlan(plan, planFilename)
+            return 0
+        applyPlan(plan, manifest, jobs, link, incrementalMode)
+        finishInstall(batchMode)
+        if profileMode:
+            writeProfile(jobs, link, hashName)
         return 0  # Return success code to OS
 
     except KeyboardInterrupt:
         # Ctrl-C just aborts (with a dedicated error code) rather than cause a
         # traceback. May want to catch it during filesystem modification stage
+        g_reaper.rollback()
         sys.stderr.write('\nUser interrupt: Aborting installer early...\n')
         sys.exit(2)
     except InstallerTraceNestingError as e:
+        g_reaper.rollback()
         sys.stderr.write('\nFatal error: ' + str(e))
         traceback.print_exc(file=sys.stderr)
         sys.stderr.write('Screenshot/copy this error and send it to the HIP team. Press ENTER to exit.')
@@ -1177,12 +3151,14 @@ B) Modifying or adding new files inside the "modules/" folder directly when you
         sys.exit(255)
     # Special handling for specific installer-understood error types (all derive from InstallerException)
     except InstallerException as e:
+        g_reaper.rollback()
         sys.stderr.write('\nFatal error: ' + str(e))
         sys.stderr.write('\nFor help, provide this error to the HIP team. Press ENTER to exit.')
         sys.stdin.readline()
         sys.exit(1)
     # And the unknowns...
     except:
+        g_reaper.rollback()
         sys.stderr.write('\nUnexpected fatal error occurred:\n')
         traceback.print_exc(file=sys.stderr)
         sys.stderr.write('Screenshot/copy this error and send it to the HIP team. Press ENTER to exit.')
@@ -1191,4 +3167,5 @@ B) Modifying or adding new files inside the "modules/" folder directly when you
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Compile worker processes in the frozen (py2exe) installer
     sys.exit(main())
@@ -5,7 +5,12 @@ import sys
 import time
 import datetime
 import argparse
-import hashlib
+import filecmp
+import mmap
+import multiprocessing
+import shutil
+
+import main as installer  # Whose checksum algorithms, blob store and install plans we share
 
 default_module_folder = '/cygdrive/c/Users/{}/Documents/Paradox Interactive/Crusader Kings II/mod/modules'.format(os.environ.get('USER', 'ziji'))
 shrinkwrap_sentinel_file = 'no_shrinkwrap.txt'
@@ -27,43 +32,185 @@ def is_binary(path):
     _, extension = os.path.splitext(path)
     return extension.lower() in ['.dds', '.tga']
 
-def encrypt(buf, length):
-    kN = len(k)
-    for i in xrange(length):
-        buf[i] ^= k[i % kN]
+def encrypt(buf, length):  # Wrapping is its own inverse, so the installer's (vectorized) unwrapping does it
+    installer.unwrapBuffer(buf, length)
 
 
+# Encrypts the file at path in place: for header_only, by rewriting just its
+# first header_len bytes, and otherwise a chunk at a time through a memory map
+# of it. Each chunk is a whole number of key periods, so it can be encrypted
+# independently of its offset.
 def encrypt_file(path, header_only=False):
-    tmp_path = path + '.tmp'
-    with open(path, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
-        length = os.path.getsize(path)
-        buf = bytearray(length)
-        fsrc.readinto(buf)
+    with open(path, 'r+b') as f:
         if header_only:
-            length = min(header_len, length)
-        encrypt(buf, length)
-        fdst.write(buf)
-    os.unlink(path)
-    os.rename(tmp_path, path)
-
-
-def cksum_file(fname):
-    cksum = hashlib.md5()
+            buf = bytearray(f.read(header_len))
+            encrypt(buf, len(buf))
+            f.seek(0)
+            f.write(buf)
+            return
+        length = os.fstat(f.fileno()).st_size
+        if length == 0:
+            return  # Can't map an empty file
+        m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_WRITE)
+        try:
+            chunk_len = installer.g_compileChunkLen
+            for start in range(0, length, chunk_len):
+                end = min(start + chunk_len, length)
+                buf = bytearray(m[start:end])
+                encrypt(buf, len(buf))
+                m[start:end] = bytes(buf)
+            m.flush()
+        finally:
+            m.close()
+
+
+manifest_version = 2
+
+
+def cksum_file(fname, hash_name):
+    cksum = installer.g_hashes[hash_name]()
     with open(fname, "rb") as f:
-        cksum.update(f.read())
+        while True:
+            buf = f.read(1 << 20)
+            if not buf:
+                break
+            cksum.update(buf)
     return cksum.hexdigest()
 
 
+# The stat cache maps the path (relative to the modules folder) of every file
+# checksummed by a previous run to the (size, mtime_ns, inode) it had and its
+# checksum, so that unchanged files needn't be checksummed again. Its first
+# line names the hash it was taken with.
+stat_cache_filename = 'shrinkwrap_cache.txt'
+stat_cache_racy_ns = 2 * 10**9  # Files modified this recently might change again unnoticed, so aren't cached
+
+
+def get_stat_key(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)  # Py3.3+
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+    return st.st_size, mtime_ns, st.st_ino
+
+
+def load_stat_cache(path, hash_name):
+    cache = {}
+    if not os.path.exists(path):
+        return cache
+    try:
+        with open(path, 'rb') as f:
+            if f.readline().rstrip('\r\n') != 'hash: {}'.format(hash_name):
+                return cache
+            for line in f:
+                virt_path, size, mtime_ns, inode, cksum = line.rstrip('\r\n').split('\t')
+                cache[virt_path] = ((int(size), int(mtime_ns), int(inode)), cksum)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('ignoring unreadable stat cache: {}\n'.format(e))
+        return {}
+    return cache
+
+
+def save_stat_cache(path, hash_name, cache):
+    with open(path + '.tmp', 'wb') as f:
+        f.write('hash: {}\n'.format(hash_name))
+        for virt_path in sorted(cache):
+            key, cksum = cache[virt_path]
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(virt_path, key[0], key[1], key[2], cksum))
+    if os.path.exists(path):
+        os.unlink(path)
+    os.rename(path + '.tmp', path)
+
+
+# With --dedup, every file with identical copies elsewhere in the modules folder
+# is moved into a content-addressed blob store (see BlobStore in main.py) and
+# its copies deleted. The blob index maps each copy's path to its blob, and a
+# later run first puts the copies back, so that it sees the tree as it was.
+def expand_blob_store(module_folder):
+    blob_index_path = os.path.join(module_folder, installer.g_blobIndexFilename)
+    blob_folder = os.path.join(module_folder, installer.g_blobStoreFolder)
+    if os.path.exists(blob_index_path):
+        with open(blob_index_path, 'rb') as f:
+            f.readline()  # time: <manifest time>
+            for line in f:
+                virt_path, blob = line.rstrip('\r\n').split(' // ')
+                shutil.copy2(os.path.join(blob_folder, blob), os.path.join(module_folder, virt_path))
+        os.unlink(blob_index_path)
+    if os.path.exists(blob_folder):
+        shutil.rmtree(blob_folder)
+
+
+# Groups the checksummed files by size and checksum, and moves one of each group
+# of identical files into the blob store, deleting the others. The checksum is
+# only a key (it could be a CRC), so copies are compared byte for byte before
+# they're deleted. Returns the blob name of every deleted or moved file's path.
+def dedup_files(module_folder, path_cksum_map, index_files):
+    groups = {}
+    for virt_path, cksum in path_cksum_map.items():
+        size = index_files[virt_path.replace(os.sep, '/')][0]
+        if size > 0 and os.path.basename(virt_path) != 'version.txt':
+            groups.setdefault((size, cksum), []).append(virt_path)
+    blob_folder = os.path.join(module_folder, installer.g_blobStoreFolder)
+    blob_map = {}
+    blobs = set()
+    for (size, cksum), virt_paths in sorted(groups.items()):
+        if len(virt_paths) < 2 or cksum in blobs:
+            continue  # Unique, or a checksum collision with another size (keep it where it is)
+        virt_paths.sort()
+        first = os.path.join(module_folder, virt_paths[0])
+        same = [p for p in virt_paths[1:] if filecmp.cmp(first, os.path.join(module_folder, p), shallow=False)]
+        if not same:
+            continue
+        if not os.path.exists(blob_folder):
+            os.mkdir(blob_folder)
+        os.rename(first, os.path.join(blob_folder, cksum))
+        blobs.add(cksum)
+        for p in same:
+            os.unlink(os.path.join(module_folder, p))
+        for p in [virt_paths[0]] + same:
+            blob_map[p] = cksum
+    return blob_map
+
+
 def get_args():
     parser = argparse.ArgumentParser(
         description="Prepare a HIP modules/ folder for build (remove unwanted files & shrinkwrap).")
     parser.add_argument('--modules-dir', default=default_module_folder,
                         help='path to modules/ folder for build')
+    # The default stays MD5 until every installer runtime (stock Py2 has no BLAKE2) and hiphub's EMF beta
+    # manifests, which must use the release's algorithm, can take another
+    parser.add_argument('--hash', choices=sorted(installer.g_hashes), default='md5',
+                        help='checksum algorithm for the release manifest (default: md5)')
+    parser.add_argument('--jobs', '-j', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes to encrypt and checksum files with (default: all CPUs)')
+    parser.add_argument('--full', action='store_true',
+                        help='checksum every file, rather than only those changed since the last run')
+    parser.add_argument('--dedup', action='store_true',
+                        help='store each set of identical files once, in a content-addressed blob store')
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help="show verbose information about what I'm doing")
     return parser.parse_args()
 
 
+# Pool entry point: encrypts the file at path if encrypt_mode is 'header' or
+# 'total' (see encrypt_file), and then checksums it if hash_name is set. Returns
+# the task along with the checksum, the file's stat cache key once done, and the
+# seconds spent on each.
+def process_file(task):
+    path, size, encrypt_mode, hash_name = task
+    start_time = time.time()
+    if encrypt_mode is not None:
+        encrypt_file(path, header_only=encrypt_mode == 'header')
+    encrypt_time = time.time()
+    cksum = cksum_file(path, hash_name) if hash_name else None
+    return task, cksum, get_stat_key(os.stat(path)), encrypt_time - start_time, time.time() - encrypt_time
+
+
+def print_throughput(stage, n_files, n_bytes, seconds):
+    mb = n_bytes / 1000.0 / 1000
+    print('%-16s %d files (%0.1fMB) in %0.2fsec of worker time (%0.1fMB/s)' %
+          (stage + ':', n_files, mb, seconds, mb / seconds if seconds else 0.0))
+
+
 args = get_args()
 module_folder = os.path.abspath(args.modules_dir)
 shrinkwrap_folder = os.path.join(module_folder, "CPRplus")
@@ -90,21 +237,69 @@ n_bytes = 0
 
 version_path = os.path.join(module_folder, 'version.txt')
 manifest_path = os.path.join(module_folder, 'release_manifest.txt')
+index_path = os.path.join(module_folder, 'module_index.txt')
+blob_index_path = os.path.join(module_folder, installer.g_blobIndexFilename)
+plans_path = os.path.join(module_folder, installer.g_bakedPlansFilename)
+# Binary manifest caches the installer leaves behind if it's run from here
+manifest_cache_paths = [os.path.join(module_folder, f) for f in ('release_manifest.bin', 'emf_beta_manifest.bin')]
 sentinel_path = os.path.join(shrinkwrap_folder, shrinkwrap_sentinel_file)
+# The stat cache is kept next to the modules folder, so it isn't packaged
+stat_cache_path = os.path.join(os.path.dirname(module_folder), stat_cache_filename)
+
+expand_blob_store(module_folder)
+
+for p in [manifest_path, index_path, plans_path] + manifest_cache_paths:
+    if os.path.exists(p):
+        os.unlink(p)
 
-# Clear unwanted files from full distribution
+# A single walk of the modules folder clears unwanted files from the full
+# distribution and sorts the rest into tasks for the pool: every file is
+# checksummed for the manifest (bar the module pack version.txt), after first
+# being encrypted if it's under real_shrinkwrap_folder and we've yet to
+# shrinkwrap. Encryption is checked for with the sentinel first. Files that
+# needn't be encrypted and are unchanged per the stat cache keep their cached
+# checksum, unless --full is given.
 
-if os.path.exists(manifest_path):
-    os.unlink(manifest_path)
+wrapping = os.path.exists(sentinel_path)
+if not wrapping:
+    sys.stderr.write('already shrinkwrapped: {}\n'.format(shrinkwrap_folder))
+
+start_scan_time = time.time()
+stat_cache = {} if args.full else load_stat_cache(stat_cache_path, args.hash)
+new_stat_cache = {}
+tasks = []
+index_dirs = []
+path_cksum_map = {}
+index_files = {}
+n_cached_files = n_cached_bytes = 0
 
 for root, dirs, files in os.walk(module_folder):
+    for i in dirs:
+        index_dirs.append(os.path.relpath(os.path.join(root, i), module_folder).replace(os.sep, '/'))
     for i in files:
         path = os.path.join(root, i)
-        if path.endswith(shrinkwrap_sentinel_file):
+        if path == sentinel_path:
             continue  # will get removed at end
         elif is_wanted(path):
+            key = get_stat_key(os.stat(path))
+            size = key[0]
             n_files += 1
-            n_bytes += os.path.getsize(path)
+            n_bytes += size
+            encrypt_mode = None
+            if wrapping and path.startswith(real_shrinkwrap_folder + os.sep):
+                encrypt_mode = 'header' if is_binary(path) else 'total'
+            virt_path = os.path.relpath(path, module_folder)
+            cached = stat_cache.get(virt_path)
+            if path == version_path:  # Don't checksum the module pack version.txt
+                tasks.append((path, size, encrypt_mode, None))
+            elif encrypt_mode is None and cached is not None and cached[0] == key:
+                n_cached_files += 1
+                n_cached_bytes += size
+                new_stat_cache[virt_path] = cached
+                path_cksum_map[virt_path] = cached[1]
+                index_files[virt_path.replace(os.sep, '/')] = (size, cached[1], 'q' if is_binary(path) else 't')
+            else:
+                tasks.append((path, size, encrypt_mode, args.hash))
         else:
             size = os.path.getsize(path)
             n_removed_files += 1
@@ -117,44 +312,120 @@ for root, dirs, files in os.walk(module_folder):
                     d = '/'
                 print("removed file: '{}' ({}KB) in '{}'".format(f, size // 1000, d))
 
+end_scan_time = time.time()
+print("scan time:       %0.2fsec (%d files, %d unchanged)" % (end_scan_time - start_scan_time, n_files,
+                                                                n_cached_files))
+
 removed_MB = n_removed_bytes / 1000 / 1000
 final_MB = n_bytes / 1000 / 1000
 
-# Now, onward to encryption of real_shrinkwrap_folder...
-
-# We will check for the encryption sentinel first
-
-if not os.path.exists(sentinel_path):
-    sys.stderr.write('already shrinkwrapped: {}\n'.format(shrinkwrap_folder))
-else:
-    start_wrap_time = time.time()
-    for root, dirs, files in os.walk(real_shrinkwrap_folder):
-        for i in files:
-            path = os.path.join(root, i)
-            encrypt_file(path, header_only=is_binary(path))
-    end_wrap_time = time.time()
-    os.unlink(sentinel_path)
-    print("shrinkwrap time: %0.2fsec" % (end_wrap_time - start_wrap_time))
-
-# Now that we've shrinkwrapped, build a checksum manifest file
+# Now, onward to encrypting and checksumming, biggest files first so that no
+# straggler is left to finish on its own. Having done so, build a checksum
+# manifest file and the module index (every folder and file in the package, so
+# the installer needn't walk module folders itself).
 start_cksum_time = time.time()
-path_cksum_map = {}
-
-for root, dirs, files in os.walk(module_folder):
-    for i in files:
-        real_path = os.path.join(root, i)
-        if real_path == version_path:  # Don't checksum the module pack version.txt
+racy_mtime_ns = int(start_scan_time * 10**9) - stat_cache_racy_ns
+n_encrypted_files = n_encrypted_bytes = n_cksum_files = n_cksum_bytes = 0
+encrypt_time = cksum_time = 0.0
+
+tasks.sort(key=lambda t: t[1], reverse=True)
+pool = multiprocessing.Pool(max(1, args.jobs))
+try:
+    for task, cksum, key, encrypt_seconds, cksum_seconds in pool.imap_unordered(process_file, tasks, 4):
+        path, size, encrypt_mode, hash_name = task
+        if encrypt_mode is not None:
+            n_encrypted_files += 1
+            n_encrypted_bytes += size
+            encrypt_time += encrypt_seconds
+        if hash_name is None:
             continue
-        virt_path = os.path.relpath(real_path, module_folder)
-        path_cksum_map[virt_path] = cksum_file(real_path)
+        n_cksum_files += 1
+        n_cksum_bytes += size
+        cksum_time += cksum_seconds
+        virt_path = os.path.relpath(path, module_folder)
+        path_cksum_map[virt_path] = cksum
+        if key[1] < racy_mtime_ns:
+            new_stat_cache[virt_path] = (key, cksum)
+        index_files[virt_path.replace(os.sep, '/')] = (size, cksum, 'q' if is_binary(path) else 't')
+    pool.close()
+    pool.join()
+finally:
+    pool.terminate()
+
+if wrapping:
+    os.unlink(sentinel_path)
+    print_throughput('encrypt', n_encrypted_files, n_encrypted_bytes, encrypt_time)
+print_throughput('checksum', n_cksum_files, n_cksum_bytes, cksum_time)
+if n_cached_files:
+    print('%-16s %d files (%0.1fMB) unchanged since the last run' % ('cached:', n_cached_files,
+                                                                      n_cached_bytes / 1000.0 / 1000))
+
+# The blobs are checksummed in the manifest as well as their copies, as the
+# installer checks what it compiles against the checksum of the file it reads.
+blob_map = {}
+if args.dedup:
+    blob_map = dedup_files(module_folder, path_cksum_map, index_files)
+    for virt_path, blob in blob_map.items():
+        new_stat_cache.pop(virt_path, None)
+        path_cksum_map[os.path.join(installer.g_blobStoreFolder, blob)] = blob
+    n_blobs = len(set(blob_map.values()))
+    n_dedup_bytes = sum(index_files[p.replace(os.sep, '/')][0] for p in blob_map) - \
+                    sum(os.path.getsize(os.path.join(module_folder, installer.g_blobStoreFolder, b))
+                        for b in set(blob_map.values()))
+    print('%-16s %d files stored as %d blobs (%0.1fMB saved)' % ('dedup:', len(blob_map), n_blobs,
+                                                                  n_dedup_bytes / 1000.0 / 1000))
+
+manifest_time = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+# Version 1 manifests have only the time in their header and are MD5. Later
+# versions' fields follow it on the same line, which older installers can still
+# parse (they just won't recognise the time), so MD5 manifests keep to version 1.
+manifest_header = 'time: {}'.format(manifest_time)
+if args.hash != 'md5':
+    manifest_header += ' // version: {} // hash: {}'.format(manifest_version, args.hash)
 
 with open(manifest_path, 'wb') as f:
-    f.write('time: {}\n'.format(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+    f.write(manifest_header + '\n')
     for p in sorted(path_cksum_map):
         f.write('{} // {}\n'.format(p, path_cksum_map[p]))
 
+# The installer only trusts the index if its time matches the manifest's, and
+# only trusts it for a module folder if the folder's directories' mtimes are
+# still as recorded here, now that we're done adding and removing files (i.e.,
+# if nothing has been added to or removed from them since)
+with open(index_path, 'wb') as f:
+    f.write('time: {}\n'.format(manifest_time))
+    for d in sorted(index_dirs):
+        mtime = int(os.stat(os.path.join(module_folder, d.replace('/', os.sep))).st_mtime)
+        f.write('{}/ // {}\n'.format(d, mtime))
+    for p in sorted(index_files):
+        f.write('{} // {}\n'.format(p, index_files[p][2]))
+
+if blob_map:
+    with open(blob_index_path, 'wb') as f:
+        f.write('time: {}\n'.format(manifest_time))
+        for p in sorted(blob_map):
+            f.write('{} // {}\n'.format(p.replace(os.sep, '/'), blob_map[p]))
+
+save_stat_cache(stat_cache_path, args.hash, new_stat_cache)
+
 end_cksum_time = time.time()
-print("checksum time:   %0.2fsec" % (end_cksum_time - start_cksum_time))
+print("pipeline time:   %0.2fsec (%s, %d jobs)" % (end_cksum_time - start_cksum_time, args.hash, args.jobs))
+
+# Bake the installer's plan for every module combination, so that it needn't
+# merge module folders itself. The installer's paths are relative to the folder
+# containing modules/, and the index we just built stands in for walking it.
+if os.path.basename(module_folder) != 'modules':
+    sys.stderr.write('not baking install plans: modules folder is not named "modules"\n')
+else:
+    start_plan_time = time.time()
+    os.chdir(os.path.dirname(module_folder))
+    installer.g_moduleIndex = installer.ModuleIndex(index_dirs, [(p, v[2] == 'q') for p, v in index_files.items()], ())
+    installer.g_blobStore = installer.BlobStore([(p.replace(os.sep, '/'), b) for p, b in blob_map.items()])
+    n_combinations, n_plans, n_entries = installer.bakeInstallPlans(manifest_time)
+    end_plan_time = time.time()
+    print("plan time:       %0.2fsec (%d combinations, %d distinct plans, %d entries)" %
+          (end_plan_time - start_plan_time, n_combinations, n_plans, n_entries))
 
 print('final package:   %d files (%dMB)' % (n_files, final_MB))
 